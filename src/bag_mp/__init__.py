@@ -0,0 +1,51 @@
+"""bag_mp: parallelizing bag processes.
+
+Submodules are imported lazily on first attribute access so that ``import bag_mp`` does not
+pay for ``dask.distributed``, ``jinja2`` or ``yaml`` until they are actually needed.
+"""
+
+import importlib
+
+_lazy_attrs = {
+    'BagMP': 'core',
+    'FlowManager': 'manager',
+    'EvalTemplate': 'manager',
+    'FutureWrapper': 'client_wrapper',
+    'create_client': 'client_wrapper',
+    'get_results': 'client_wrapper',
+    'synchronize': 'client_wrapper',
+    'while_loop': 'client_wrapper',
+    'for_loop': 'client_wrapper',
+    'iter_completed': 'client_wrapper',
+    'cancel': 'client_wrapper',
+    'connect_client': 'cluster',
+    'start_cluster': 'cluster',
+    'ArtifactStore': 'artifacts',
+    'BatchJournal': 'journal',
+    'LazyResult': 'results',
+    'Pickle': 'file',
+    'Yaml': 'file',
+    'to_immutable': 'immutable',
+}
+
+_submodules = {'artifacts', 'batching', 'client_wrapper', 'cluster', 'core', 'file', 'immutable',
+               'journal', 'manager', 'metrics', 'process', 'profiling', 'results',
+               'scheduling', 'simulator', 'trace'}
+
+__all__ = list(_lazy_attrs)
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f'{__name__}.{name}')
+    try:
+        module_name = _lazy_attrs[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    value = getattr(importlib.import_module(f'{__name__}.{module_name}'), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,36 @@
+"""Profiles a BAG child process when $BAG_MP_PROFILE_OUT is set.
+
+bag_mp prepends this directory to PYTHONPATH of profiled jobs, so the python started by
+run_bag.sh imports it at startup. The profile is dumped to $BAG_MP_PROFILE_OUT at exit.
+Any other sitecustomize module further down sys.path is still imported.
+"""
+
+import os
+import sys
+import atexit
+import cProfile
+import importlib
+
+_out = os.environ.get('BAG_MP_PROFILE_OUT', None)
+if _out:
+    _profiler = cProfile.Profile()
+
+    def _dump() -> None:
+        _profiler.disable()
+        _profiler.dump_stats(_out)
+
+    atexit.register(_dump)
+    _profiler.enable()
+
+# chain-load the sitecustomize we are shadowing
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+_saved_path = sys.path[:]
+sys.path[:] = [p for p in sys.path if os.path.abspath(p or '.') != _this_dir]
+_this_module = sys.modules.pop('sitecustomize', None)
+try:
+    importlib.import_module('sitecustomize')
+except ImportError:
+    if _this_module is not None:
+        sys.modules['sitecustomize'] = _this_module
+finally:
+    sys.path[:] = _saved_path
@@ -0,0 +1,361 @@
+"""Shared content-addressed store of generated artifacts.
+
+Generated libraries and LVS/RCX results are written by BAG under its work_dir, on
+whichever node ran the job. The artifact store keeps a copy of them in a shared directory,
+keyed by the bag_id, the digest of the specs and the stage that produced them, so that another node,
+or the next sweep, restores them instead of generating them again.
+
+Layout of the store::
+
+    blobs/ab/abcdef....gz        gzip-compressed file contents, named by their sha256
+    manifests/<key>.json         one manifest per entry: relative path -> blob, size, mode
+
+Files with the same contents are stored once, whatever entry they belong to. A manifest's
+mtime is its last use, garbage collection drops the least recently used entries until
+the store fits its size budget and then deletes the blobs no manifest refers to anymore.
+Restoring an entry only decompresses the files that differ from what is already on disk.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional
+
+import os
+import gzip
+import json
+import time
+import shutil
+import fcntl
+import hashlib
+from pathlib import Path
+
+from .immutable import digest
+
+ARTIFACT_DIR_ENV = 'BAG_MP_ARTIFACT_DIR'
+# name of the job output dump inside an entry
+OUTPUT_NAME = '__output__'
+# blobs younger than this are never collected, a concurrent put may be about to use them
+GC_GRACE_PERIOD = 3600
+# minimum seconds between two automatic collections from the same process
+GC_INTERVAL = 60
+# files modified this close to their last check may keep their mtime, they are re-hashed
+MTIME_SLACK_NS = 2 * 10 ** 9
+# restored entries are recorded here, relative to the restore directory
+RESTORED_DIRNAME = '.bag_mp_artifacts'
+
+_CHUNK_SIZE = 1024 ** 2
+
+
+def _file_sha256(path: os.PathLike) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _file_id(path: os.PathLike) -> List[int]:
+    """Returns the inode, size and mtime of path, empty if it does not exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return []
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def _walk_files(path: Path) -> Iterable[Path]:
+    if path.is_file():
+        yield path
+        return
+    for dirpath, _, fnames in os.walk(path):
+        for fname in sorted(fnames):
+            fpath = Path(dirpath) / fname
+            if fpath.is_file() and not fpath.is_symlink():
+                yield fpath
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ArtifactStore:
+    """
+    A content-addressed store of generated files.
+
+    Parameters
+    ----------
+    root: os.PathLike
+        the store directory, has to be visible to every worker. Created if missing.
+    max_bytes: Optional[int]
+        size budget of the compressed blobs, least recently used entries are collected
+        beyond it. None for no limit.
+    compresslevel: int
+        gzip compression level.
+    """
+
+    def __init__(self, root: os.PathLike, max_bytes: Optional[int] = None,
+                 compresslevel: int = 6) -> None:
+        self.root = Path(root).resolve()
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self.blobs_dir = self.root / 'blobs'
+        self.manifests_dir = self.root / 'manifests'
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.manifests_dir.mkdir(parents=True, exist_ok=True)
+        self._last_gc = 0.0
+
+    def __repr__(self) -> str:
+        return f'ArtifactStore({str(self.root)!r}, max_bytes={self.max_bytes})'
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_last_gc'] = 0.0
+        return state
+
+    @staticmethod
+    def key(specs: Any, stage: str, bag_id: str) -> str:
+        """Returns the key of the artifacts produced by stage for specs, in the work_dir of
+        bag_id."""
+        return f'{bag_id}-{digest(specs)}-{stage}'
+
+    def _manifest_path(self, key: str) -> Path:
+        return self.manifests_dir / f'{key}.json'
+
+    def _blob_path(self, sha: str) -> Path:
+        return self.blobs_dir / sha[:2] / f'{sha}.gz'
+
+    def has(self, key: str) -> bool:
+        return self._manifest_path(key).exists()
+
+    def manifest(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the manifest of key, None if it is not in the store."""
+        try:
+            with open(self._manifest_path(key), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _put_blob(self, path: Path) -> str:
+        sha = _file_sha256(path)
+        blob_path = self._blob_path(sha)
+        if blob_path.exists():
+            # a fresh mtime keeps it out of a concurrent gc's reach
+            os.utime(blob_path)
+            return sha
+        blob_path.parent.mkdir(exist_ok=True)
+        tmp_path = blob_path.with_name(f'.{blob_path.name}.{os.getpid()}.tmp')
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', self.compresslevel) as dst:
+            shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+        os.replace(tmp_path, blob_path)
+        return sha
+
+    def put(self, key: str, paths: Iterable[os.PathLike], base_dir: os.PathLike,
+            output: Optional[os.PathLike] = None, **meta: Any) -> Dict[str, Any]:
+        """
+        Stores files and directories under key, replacing a previous entry.
+
+        Parameters
+        ----------
+        key: str
+            the entry, see key.
+        paths: Iterable[os.PathLike]
+            files or directories to store, missing ones are skipped. Directories are
+            stored recursively.
+        base_dir: os.PathLike
+            paths are recorded relative to it, restore puts them back relative to the
+            restore directory. Usually the BAG work_dir.
+        output: Optional[os.PathLike]
+            the job's output dump, stored under OUTPUT_NAME.
+        meta:
+            extra information kept in the manifest.
+
+        Returns
+        -------
+        manifest: Dict[str, Any]
+            the manifest of the new entry.
+        """
+        base_dir = Path(base_dir).resolve()
+        files = {}
+        size = 0
+        to_store = [(Path(path).resolve(), None) for path in paths]
+        if output is not None:
+            to_store.append((Path(output).resolve(), OUTPUT_NAME))
+        for path, name in to_store:
+            if not path.exists():
+                continue
+            for fpath in _walk_files(path):
+                sha = self._put_blob(fpath)
+                nbytes = self._blob_path(sha).stat().st_size
+                rel = name if name is not None else os.path.relpath(fpath, base_dir)
+                files[rel] = dict(sha=sha, size=fpath.stat().st_size,
+                                  mode=fpath.stat().st_mode & 0o777)
+                size += nbytes
+        manifest = dict(key=key, created=time.time(), files=files, nbytes=size, meta=meta)
+        _atomic_write(self._manifest_path(key),
+                      json.dumps(manifest, default=str).encode('utf-8'))
+        if self.max_bytes is not None and time.time() - self._last_gc > GC_INTERVAL:
+            self.gc()
+        return manifest
+
+    def restore(self, key: str, dest_dir: os.PathLike) -> Optional[Dict[str, Path]]:
+        """
+        Pulls the entry key into dest_dir.
+
+        Files already restored from the same blob and not modified since, judged by their
+        inode, size and mtime or by their contents right after a restore, are left alone, so
+        restoring an entry that is in place is cheap. Marks the entry as used.
+
+        Returns
+        -------
+        files: Optional[Dict[str, Path]]
+            the restored path of each stored file, the output dump under OUTPUT_NAME.
+            None if key is not in the store or one of its blobs is missing.
+        """
+        manifest = self.manifest(key)
+        if manifest is None:
+            return None
+        dest_dir = Path(dest_dir).resolve()
+        restored_dir = dest_dir / RESTORED_DIRNAME
+        restored_dir.mkdir(parents=True, exist_ok=True)
+        # what this directory got from the store so far:
+        # path -> [sha, inode, size, mtime_ns, time its contents were last known to match sha]
+        state_path = restored_dir / 'state.json'
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            state = {}
+
+        files = {}
+        for rel, info in manifest['files'].items():
+            if rel == OUTPUT_NAME:
+                target = restored_dir / f'{key}{OUTPUT_NAME}'
+            else:
+                target = dest_dir / rel
+            files[rel] = target
+            state_key = str(target)
+            file_id = _file_id(target)
+            known = state.get(state_key, None)
+            if isinstance(known, list) and known[:-1] == [info['sha'], *file_id]:
+                # like git's racily clean files, a write right after the last check may leave
+                # inode, size and mtime alone, those files are compared by contents
+                if file_id[2] < known[-1] - MTIME_SLACK_NS:
+                    continue
+                if _file_sha256(target) == info['sha']:
+                    state[state_key] = [info['sha'], *file_id, time.time_ns()]
+                    continue
+            blob_path = self._blob_path(info['sha'])
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = target.with_name(f'.{target.name}.{os.getpid()}.tmp')
+            try:
+                with gzip.open(blob_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+            except FileNotFoundError:
+                # collected under our feet, the caller regenerates
+                return None
+            os.chmod(tmp_path, info['mode'])
+            os.replace(tmp_path, target)
+            state[state_key] = [info['sha'], *_file_id(target), time.time_ns()]
+        _atomic_write(state_path, json.dumps(state).encode('utf-8'))
+        try:
+            os.utime(self._manifest_path(key))
+        except FileNotFoundError:
+            pass
+        return files
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Returns the manifests of all entries, with their last use as 'used'."""
+        entries = []
+        for path in self.manifests_dir.glob('*.json'):
+            try:
+                used = path.stat().st_mtime
+                with open(path, 'r') as f:
+                    manifest = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            manifest['used'] = used
+            entries.append(manifest)
+        return entries
+
+    def remove(self, key: str) -> None:
+        """Drops an entry, its blobs go away on the next gc."""
+        try:
+            self._manifest_path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def gc(self, max_bytes: Optional[int] = None) -> int:
+        """
+        Drops least recently used entries until the blobs fit max_bytes, then deletes
+        unreferenced blobs. Only one process collects at a time.
+
+        Parameters
+        ----------
+        max_bytes: Optional[int]
+            size budget, defaults to the store's. None only deletes unreferenced blobs.
+
+        Returns
+        -------
+        freed: int
+            number of bytes deleted.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        self._last_gc = time.time()
+        with open(self.root / '.gc.lock', 'w') as lock_f:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is collecting
+                return 0
+            try:
+                return self._gc(max_bytes)
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _gc(self, max_bytes: Optional[int]) -> int:
+        blob_sizes = {}
+        for blob_path in self.blobs_dir.glob('*/*.gz'):
+            try:
+                stat = blob_path.stat()
+            except FileNotFoundError:
+                continue
+            blob_sizes[blob_path.name[:-len('.gz')]] = (blob_path, stat.st_size, stat.st_mtime)
+        entries = sorted(self.entries(), key=lambda manifest: manifest['used'])
+        refs = {}
+        for manifest in entries:
+            for info in manifest['files'].values():
+                refs[info['sha']] = refs.get(info['sha'], 0) + 1
+        # unreferenced blobs go anyway, dropping entries would not make room for them
+        total = sum(size for sha, (_, size, _) in blob_sizes.items() if refs.get(sha, 0) > 0)
+
+        # least recently used first, a blob only frees space with its last reference
+        for manifest in entries:
+            if max_bytes is None or total <= max_bytes:
+                break
+            self.remove(manifest['key'])
+            for info in manifest['files'].values():
+                refs[info['sha']] -= 1
+                if refs[info['sha']] == 0 and info['sha'] in blob_sizes:
+                    total -= blob_sizes[info['sha']][1]
+
+        freed = 0
+        now = time.time()
+        for sha, (blob_path, size, mtime) in blob_sizes.items():
+            if refs.get(sha, 0) > 0 or now - mtime < GC_GRACE_PERIOD:
+                continue
+            try:
+                blob_path.unlink()
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
+
+
+def get_artifact_store(root: Optional[os.PathLike] = None,
+                       max_bytes: Optional[int] = None) -> Optional[ArtifactStore]:
+    """Returns the store at root, or at $BAG_MP_ARTIFACT_DIR, None when neither is set."""
+    root = os.environ.get(ARTIFACT_DIR_ENV, None) if root is None else root
+    if root is None:
+        return None
+    return ArtifactStore(root, max_bytes=max_bytes)
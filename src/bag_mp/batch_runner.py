@@ -0,0 +1,84 @@
+"""Runs a micro-batch of BAG run scripts in one python process.
+
+Started through run_bag.sh like a BAG run script, so BAG is imported and initialized once
+for the whole batch:
+
+    ./run_bag.sh batch_runner.py <batch file> --dump <status file> --format <yaml|pickle>
+
+The batch file is a list of jobs, each a dictionary with the run script, its specs file,
+dump file, extra arguments, log file and log file mode. Every job runs as __main__ with
+its own sys.argv and its output redirected to its own log file. A failing job does not
+stop the batch: the status file gets one {'ok': bool, 'error': str} entry per job.
+
+This file must only depend on the standard library and yaml, it runs in BAG's python.
+"""
+
+import sys
+import runpy
+import pickle
+import argparse
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+
+def _load(path, io_format):
+    if io_format == 'yaml':
+        import yaml
+        with open(path, 'r') as f:
+            return yaml.load(f, Loader=yaml.Loader)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _dump(obj, path, io_format):
+    if io_format == 'yaml':
+        import yaml
+        with open(path, 'w') as f:
+            yaml.dump(obj, f)
+    else:
+        with open(path, 'wb') as f:
+            pickle.dump(obj, f)
+
+
+def run_job(job, io_format):
+    argv = [job['script'], job['specs'], '--dump', job['dump'], '--format', io_format]
+    argv += list(job['args'])
+    old_argv = sys.argv
+    sys.argv = argv
+    with open(job['log'], job.get('log_mode', 'w')) as log_f:
+        with redirect_stdout(log_f), redirect_stderr(log_f):
+            print(f'[batch] {" ".join(argv)}')
+            try:
+                runpy.run_path(job['script'], run_name='__main__')
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    return {'ok': False, 'error': f'exit code {e.code}'}
+            except BaseException as e:
+                if isinstance(e, KeyboardInterrupt):
+                    raise
+                traceback.print_exc(file=log_f)
+                return {'ok': False, 'error': repr(e)}
+            finally:
+                sys.argv = old_argv
+                log_f.flush()
+    return {'ok': True, 'error': ''}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='runs a batch of BAG run scripts')
+    parser.add_argument('batch', help='the batch file')
+    parser.add_argument('--dump', required=True, help='where to write the job statuses')
+    parser.add_argument('--format', default='yaml', choices=['yaml', 'pickle'])
+    args = parser.parse_args()
+
+    jobs = _load(args.batch, args.format)
+    statuses = []
+    for job in jobs:
+        statuses.append(run_job(job, args.format))
+        print(f'[batch] {job["specs"]}: {"ok" if statuses[-1]["ok"] else "failed"}')
+        sys.stdout.flush()
+    _dump(statuses, args.dump, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Micro-batching of small BagMP jobs into a single BAG process.
+
+For cheap jobs (schematic-only gen_cell, quick DC sims) starting run_bag.sh and importing
+BAG costs more than the job itself. With batching enabled, BagMP still submits one task
+per job under its own key, but the task only waits for the micro-batch it was assigned
+to: a MicroBatcher collects jobs of the same stage, bag_id and io_format, and once
+batch_size jobs are queued or batch_window seconds have passed it submits one batch task
+that runs all of them through batch_runner.py in one subprocess.
+
+Failures stay isolated: a job whose run script fails raises in its own task only, and if
+the whole batch process dies every job of the batch falls back to running on its own.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import math
+import uuid
+import threading
+
+# seconds a partial batch waits for more jobs before it is submitted
+BATCH_WINDOW = 0.1
+
+BatchGroup = Tuple[str, str, str]
+
+
+def await_batch(name: str, idx: int, fallback: Callable, *args, **kwargs) -> Any:
+    """
+    Returns the result of job idx of a micro-batch, runs on the workers.
+
+    The worker thread is given back while waiting. When the batch itself failed, the job
+    is run alone through fallback(*args, **kwargs).
+    """
+    from distributed import Variable, secede, rejoin
+
+    secede()
+    try:
+        try:
+            results = Variable(name).get().result()
+        except Exception:
+            results = None
+    finally:
+        rejoin()
+    if results is None:
+        return fallback(*args, **kwargs)
+    ok, value = results[idx]
+    if not ok:
+        raise SystemError(value)
+    return value
+
+
+class _Batch:
+    def __init__(self, group: BatchGroup) -> None:
+        self.group = group
+        self.name = f'bag_mp-batch-{uuid.uuid4().hex}'
+        self.jobs: List[Tuple[str, Any, Dict[str, Any]]] = []
+        self.keys: Dict[str, int] = {}
+        self.members = 0
+        self.priority = -math.inf
+        self.future = None
+        self.timer: Optional[threading.Timer] = None
+
+
+class MicroBatcher:
+    """
+    Groups jobs into micro-batches on the client.
+
+    Parameters
+    ----------
+    submit_batch: Callable
+        submit_batch(group, jobs, priority) submits the batch task and returns its future.
+        group is (stage, bag_id, io_format), jobs a list of (key, specs, flags).
+    batch_size: int
+        a batch is submitted as soon as it holds this many jobs.
+    batch_window: float
+        seconds after its first job at which a partial batch is submitted.
+    """
+
+    def __init__(self, submit_batch: Callable, batch_size: int,
+                 batch_window: float = BATCH_WINDOW) -> None:
+        self.submit_batch = submit_batch
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._open: Dict[BatchGroup, _Batch] = {}
+        self._batches: Dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def add(self, group: BatchGroup, key: str, specs: Any, flags: Dict[str, Any],
+            priority: int = 0) -> Tuple[str, int]:
+        """Queues a job, returns the name of its batch and its index in it. The batch runs
+        with the highest dask priority of its jobs."""
+        full = None
+        with self._lock:
+            batch = self._open.get(group, None)
+            if batch is None:
+                batch = self._open[group] = _Batch(group)
+                self._batches[batch.name] = batch
+                if self.batch_window is not None:
+                    batch.timer = threading.Timer(self.batch_window, self._flush, (batch,))
+                    batch.timer.daemon = True
+                    batch.timer.start()
+            idx = batch.keys.get(key, None)
+            if idx is None:
+                idx = batch.keys[key] = len(batch.jobs)
+                batch.jobs.append((key, specs, flags))
+            batch.members += 1
+            batch.priority = max(batch.priority, priority)
+            if len(batch.jobs) >= self.batch_size:
+                full = batch
+        if full is not None:
+            self._flush(full)
+        return batch.name, idx
+
+    def release(self, name: str) -> None:
+        """Called when a job of batch name is released, the batch result is dropped once
+        none of its jobs need it anymore."""
+        with self._lock:
+            batch = self._batches.get(name, None)
+            if batch is None:
+                return
+            batch.members -= 1
+            if batch.members > 0 or batch.future is None:
+                return
+            del self._batches[name]
+        from distributed import Variable
+        try:
+            Variable(name).delete()
+        except Exception:
+            # the client is shutting down
+            pass
+        batch.future = None
+
+    def flush(self) -> None:
+        """Submits all partial batches now."""
+        with self._lock:
+            batches = list(self._open.values())
+        for batch in batches:
+            self._flush(batch)
+
+    def _flush(self, batch: _Batch) -> None:
+        with self._lock:
+            if self._open.get(batch.group, None) is not batch:
+                # already submitted
+                return
+            del self._open[batch.group]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        from distributed import Variable
+        batch.future = self.submit_batch(batch.group, batch.jobs, batch.priority)
+        Variable(batch.name).set(batch.future)
+        with self._lock:
+            done = batch.members <= 0
+        if done:
+            # every job was dropped before the batch was submitted
+            batch.members = 1
+            self.release(batch.name)
@@ -1,17 +1,46 @@
 from __future__ import annotations
 
-from typing import List, Union
+from typing import List, Union, Iterator, Tuple, Callable
 
+import time
 import operator as op
+from concurrent.futures import ThreadPoolExecutor
 from dask.distributed import (
-    get_client, wait, Client, Future
+    get_client, wait, as_completed, Client, Future
 )
 
+from .metrics import RESULTS_GATHERED, SYNC_WAIT
+
 
 def create_client(**kwargs):
     return Client(**kwargs)
 
 
+_callback_executor = None
+
+
+def add_release_callback(future: Future, fn: Callable[[str], None]) -> None:
+    """
+    Call fn(status) in a separate thread once future is finished, erred, cancelled or
+    released.
+
+    Unlike Future.add_done_callback this does not keep a reference to the future, so
+    dropping the last reference still releases the task (and cancels it if it is running).
+    fn then gets status 'cancelled'.
+    """
+    global _callback_executor
+    if _callback_executor is None:
+        _callback_executor = ThreadPoolExecutor(1, thread_name_prefix='bag_mp-callback')
+    state = future._state
+
+    async def _wait_state():
+        while state.status == 'pending':
+            await state.wait()
+        _callback_executor.submit(fn, state.status)
+
+    future.client.loop.add_callback(_wait_state)
+
+
 class FutureWrapper(Future):
 
     def __init__(self,  key, client=None, inform=True, state=None):
@@ -192,7 +221,9 @@ def get_results(fs: FS, errors='raise', direct=None, asynchronous=None):
     client = get_client()
     if isinstance(fs, FutureWrapper):
         fs = [fs]
-    return client.gather(fs, errors, direct, asynchronous)
+    results = client.gather(fs, errors, direct, asynchronous)
+    RESULTS_GATHERED.inc(len(fs) if hasattr(fs, '__len__') else 1)
+    return results
 
 
 def synchronize(fs: FS, timeout=None,
@@ -215,4 +246,50 @@ def synchronize(fs: FS, timeout=None,
         fs = [fs]
     if return_when is None:
         return_when = 'ALL_COMPLETED'
-    return wait(fs, timeout, return_when)
+    t0 = time.monotonic()
+    try:
+        return wait(fs, timeout, return_when)
+    finally:
+        SYNC_WAIT.observe(time.monotonic() - t0)
+
+
+def iter_completed(fs: List[FutureWrapper]) -> Iterator[Tuple[int, FutureWrapper]]:
+    """
+    Iterate over futures in the order they finish
+
+    Parameters
+    ----------
+    fs: list of futures
+
+    Returns
+    -------
+    Iterator of (index in fs, future) pairs
+    """
+    # track plain futures, FutureWrapper.__eq__ submits a task instead of comparing, and
+    # several entries of fs may share a key
+    plain = [Future(f.key, f.client) for f in fs]
+    idx_of = {id(f): idx for idx, f in enumerate(plain)}
+    for f in as_completed(plain):
+        idx = idx_of[id(f)]
+        yield idx, fs[idx]
+
+
+def cancel(fs: FS, force=False):
+    """
+    Cancel running or pending futures
+
+    Tasks depending on the cancelled futures are cancelled as well. A running bag
+    subprocess notices the cancellation within process.POLL_INTERVAL seconds and its whole
+    process tree is killed.
+
+    Parameters
+    ----------
+    fs: list of futures
+    force: boolean
+        Cancel the futures even if other clients desire them, e.g. the same design requested
+        by another optimizer.
+    """
+    client = get_client()
+    if isinstance(fs, FutureWrapper):
+        fs = [fs]
+    return client.cancel(fs, force=force)
@@ -0,0 +1,142 @@
+"""Persistent, discoverable dask cluster for short-lived bag_mp processes.
+
+A scheduler started with :func:`start_cluster` writes its address to a scheduler file and
+outlives the process that started it. Later scripts and notebooks attach to it through
+:func:`connect_client` instead of spinning up a new ``LocalCluster`` every time.
+"""
+
+from typing import Optional, Union
+
+import os
+import sys
+import time
+import subprocess
+from pathlib import Path
+
+SCHEDULER_FILE_ENV = 'BAG_MP_SCHEDULER_FILE'
+CONNECT_TIMEOUT = 5
+STARTUP_TIMEOUT = 60
+
+
+def get_scheduler_file(scheduler_file: Optional[Union[str, os.PathLike]] = None) \
+        -> Optional[Path]:
+    """Returns the scheduler file to use, falling back to $BAG_MP_SCHEDULER_FILE."""
+    if scheduler_file is None:
+        scheduler_file = os.environ.get(SCHEDULER_FILE_ENV, None)
+    if scheduler_file is None:
+        return None
+    return Path(scheduler_file).expanduser().resolve()
+
+
+def start_cluster(scheduler_file: Union[str, os.PathLike], n_workers: int = 1,
+                  nthreads: int = 1, memory_limit: str = 'auto',
+                  timeout: float = STARTUP_TIMEOUT) -> Path:
+    """
+    Starts a detached dask scheduler and workers that publish their address to scheduler_file.
+
+    The processes run in their own session so they keep serving after the calling process
+    exits. Their output goes to scheduler.log and worker.log next to the scheduler file.
+
+    Parameters
+    ----------
+    scheduler_file: os.PathLike
+        path of the json file the scheduler writes its address to.
+    n_workers: int
+        number of worker processes.
+    nthreads: int
+        number of threads per worker process.
+    memory_limit: str
+        memory limit per worker process, passed to dask-worker.
+    timeout: float
+        seconds to wait for the scheduler file to show up.
+
+    Returns
+    -------
+    scheduler_file: Path
+        the resolved scheduler file path.
+    """
+    scheduler_file = Path(scheduler_file).expanduser().resolve()
+    scheduler_file.parent.mkdir(parents=True, exist_ok=True)
+    if scheduler_file.exists():
+        scheduler_file.unlink()
+
+    log_dir = scheduler_file.parent
+    # the address is discovered through the scheduler file, so any free port will do
+    sched_cmd = [sys.executable, '-m', 'distributed.cli.dask_scheduler', '--port', '0',
+                 '--scheduler-file', str(scheduler_file)]
+    worker_cmd = [sys.executable, '-m', 'distributed.cli.dask_worker',
+                  '--scheduler-file', str(scheduler_file),
+                  '--nworkers', str(n_workers), '--nthreads', str(nthreads),
+                  '--memory-limit', str(memory_limit)]
+
+    with open(log_dir / 'scheduler.log', 'a') as log_f:
+        sched_proc = subprocess.Popen(sched_cmd, stdout=log_f, stderr=log_f,
+                                      stdin=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + timeout
+    while not scheduler_file.exists():
+        if sched_proc.poll() is not None:
+            raise RuntimeError(f'scheduler exited, see {log_dir / "scheduler.log"}')
+        if time.time() > deadline:
+            raise TimeoutError(f'scheduler did not write {scheduler_file} in {timeout} seconds')
+        time.sleep(0.1)
+
+    with open(log_dir / 'worker.log', 'a') as log_f:
+        subprocess.Popen(worker_cmd, stdout=log_f, stderr=log_f, stdin=subprocess.DEVNULL,
+                         start_new_session=True)
+    return scheduler_file
+
+
+def connect_client(scheduler_file: Optional[Union[str, os.PathLike]] = None,
+                   autostart: bool = False, n_workers: int = 1, nthreads: int = 1,
+                   timeout: float = CONNECT_TIMEOUT, **kwargs):
+    """
+    Returns a dask client, reusing whatever is cheapest to get.
+
+    In order of preference: the client already registered in this process, a running
+    scheduler discovered through scheduler_file (or $BAG_MP_SCHEDULER_FILE), a newly started
+    persistent scheduler if autostart is True, and finally a fresh Client(**kwargs).
+
+    Parameters
+    ----------
+    scheduler_file: os.PathLike
+        scheduler file of a persistent cluster.
+    autostart: bool
+        True to start a persistent cluster if none is reachable through scheduler_file.
+    n_workers: int
+        number of worker processes when a cluster is started.
+    nthreads: int
+        number of threads per worker process when a cluster is started.
+    timeout: float
+        seconds to wait when connecting to an existing scheduler.
+    kwargs:
+        passed to Client when no persistent scheduler is used.
+
+    Returns
+    -------
+    client: Client
+        the connected client.
+    """
+    from dask.distributed import Client, get_client
+
+    try:
+        return get_client()
+    except ValueError:
+        pass
+
+    scheduler_file = get_scheduler_file(scheduler_file)
+    if scheduler_file is None:
+        return Client(**kwargs)
+
+    if scheduler_file.exists():
+        try:
+            return Client(scheduler_file=str(scheduler_file), timeout=timeout)
+        except OSError:
+            # stale scheduler file left behind by a dead scheduler
+            if not autostart:
+                raise
+
+    if not autostart:
+        raise FileNotFoundError(f'no scheduler file at {scheduler_file}, start one with '
+                                f'start_cluster() or pass autostart=True')
+    start_cluster(scheduler_file, n_workers=n_workers, nthreads=nthreads)
+    return Client(scheduler_file=str(scheduler_file), timeout=STARTUP_TIMEOUT)
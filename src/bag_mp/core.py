@@ -1,73 +1,651 @@
-from typing import Dict, Any, Callable
+from __future__ import annotations
+
+from typing import Dict, Any, Callable, List, Optional, Tuple, TYPE_CHECKING
 
 import os
+import time
+import weakref
+import threading
 from pathlib import Path
-import subprocess
-from dask.distributed import get_client
+from functools import lru_cache
+from collections import Counter
 
-from .file import Pickle, Yaml
-from .immutable import to_immutable
+from .file import io_cls_dict
+from .immutable import to_immutable, digest
+from .cluster import connect_client
+from .journal import BatchJournal, load_result, run_journaled
+from .scheduling import AdmissionController, default_owner
+from .process import run_cancellable
+from .results import (load_output, project_output, remove_spilled, SPILL_THRESHOLD,
+                      SPILL_DIRNAME)
+from .profiling import run_profiled, get_child_env, collect_profiles, profile_block
+from .batching import MicroBatcher, await_batch, BATCH_WINDOW
+from .trace import TraceRecorder, ensure_task_stream
+from .artifacts import ArtifactStore, get_artifact_store, OUTPUT_NAME
+from . import metrics
 
-from .client_wrapper import FutureWrapper, create_client
+if TYPE_CHECKING:
+    from .client_wrapper import FutureWrapper
 
 PROCESS_TIMEOUT = 10000
-BAG2_FRAMEWORK = os.environ.get('BAG2_FRAMEWORK', 'BAG_framework')
-BAG3_FRAMEWORK = os.environ.get('BAG3_FRAMEWORK', 'BAG_framework')
-BAG2_WORK_DIR = Path(BAG2_FRAMEWORK).parent
-BAG3_WORK_DIR = Path(BAG3_FRAMEWORK).parent
-
-config_dict = {
-    'BAG2': {
-        'work_dir': BAG2_WORK_DIR,
-        'env_vars': Path(BAG2_FRAMEWORK).parent / '.cshrc',
-        'framework': Path(BAG2_FRAMEWORK),
-        'gen_cell': Path(BAG2_FRAMEWORK) / 'run_scripts' / 'gen_cell.py',
-        'sim_cell': Path(BAG2_FRAMEWORK) / 'run_scripts' / 'sim_cell.py',
-        'meas_cell': Path(BAG2_FRAMEWORK) / 'run_scripts' / 'meas_cell.py',
-        'envs': {
-            'BAG_WORK_DIR': BAG2_WORK_DIR,
-            'BAG_TECH_CONFIG_DIR': BAG2_WORK_DIR/'GF14LPP',
-            'BAG_CONFIG_PATH': BAG2_WORK_DIR/'bag_config.yaml',
-        }
-    },
-    'BAG3': {
-        'work_dir': Path(BAG3_FRAMEWORK).parent,
-        'env_vars': Path(BAG3_FRAMEWORK).parent / '.cshrc',
-        'framework': Path(BAG3_FRAMEWORK),
-        'gen_cell': Path(BAG3_FRAMEWORK) / 'run_scripts' / 'gen_cell.py',
-        'sim_cell': Path(BAG3_FRAMEWORK) / 'run_scripts' / 'sim_cell.py',
-        'meas_cell': Path(BAG3_FRAMEWORK) / 'run_scripts' / 'meas_cell.py',
-        'envs': {
-            'BAG_WORK_DIR': BAG3_WORK_DIR,
-            'BAG_TECH_CONFIG_DIR': BAG3_WORK_DIR / 'GF14LPP',
-            'BAG_CONFIG_PATH': BAG3_WORK_DIR / 'bag_config.yaml',
+BATCH_RUNNER = Path(__file__).resolve().parent / 'batch_runner.py'
+# stages of a split gen_cell, named after the gen_cell flag enabling them
+GEN_CELL_STAGES = ('gen_sch', 'gen_lay', 'run_lvs', 'run_rcx')
+
+
+# what each gen_cell stage leaves in work_dir, formatted with the string entries of the
+# specs and kept in the artifact store
+ARTIFACT_PATHS = {
+    'gen_sch': ['{impl_lib}'],
+    'gen_lay': ['{impl_lib}'],
+    'run_lvs': ['pvs_run/lvs_run_dir/{impl_lib}/{impl_cell}'],
+    'run_rcx': ['pvs_run/rcx_run_dir/{impl_lib}/{impl_cell}'],
+}
+
+
+@lru_cache(maxsize=None)
+def get_config_dict() -> Dict[str, Dict[str, Any]]:
+    """Builds the BAG configuration table from the environment on first use."""
+    bag2_framework = os.environ.get('BAG2_FRAMEWORK', 'BAG_framework')
+    bag3_framework = os.environ.get('BAG3_FRAMEWORK', 'BAG_framework')
+    bag2_work_dir = Path(bag2_framework).parent
+    bag3_work_dir = Path(bag3_framework).parent
+    return {
+        'BAG2': {
+            'work_dir': bag2_work_dir,
+            'env_vars': Path(bag2_framework).parent / '.cshrc',
+            'framework': Path(bag2_framework),
+            'gen_cell': Path(bag2_framework) / 'run_scripts' / 'gen_cell.py',
+            'sim_cell': Path(bag2_framework) / 'run_scripts' / 'sim_cell.py',
+            'meas_cell': Path(bag2_framework) / 'run_scripts' / 'meas_cell.py',
+            'envs': {
+                'BAG_WORK_DIR': bag2_work_dir,
+                'BAG_TECH_CONFIG_DIR': bag2_work_dir/'GF14LPP',
+                'BAG_CONFIG_PATH': bag2_work_dir/'bag_config.yaml',
+            },
+            'artifacts': ARTIFACT_PATHS,
+        },
+        'BAG3': {
+            'work_dir': Path(bag3_framework).parent,
+            'env_vars': Path(bag3_framework).parent / '.cshrc',
+            'framework': Path(bag3_framework),
+            'gen_cell': Path(bag3_framework) / 'run_scripts' / 'gen_cell.py',
+            'sim_cell': Path(bag3_framework) / 'run_scripts' / 'sim_cell.py',
+            'meas_cell': Path(bag3_framework) / 'run_scripts' / 'meas_cell.py',
+            'envs': {
+                'BAG_WORK_DIR': bag3_work_dir,
+                'BAG_TECH_CONFIG_DIR': bag3_work_dir / 'GF14LPP',
+                'BAG_CONFIG_PATH': bag3_work_dir / 'bag_config.yaml',
+            },
+            'artifacts': ARTIFACT_PATHS,
         }
     }
-}
 
-io_cls_dict = {
-    'pickle': Pickle,
-    'yaml': Yaml,
+
+def __getattr__(name):
+    # config_dict used to be built at import time, keep it reachable for existing callers
+    if name == 'config_dict':
+        return get_config_dict()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _submit(func: Callable, *args, **kwargs) -> FutureWrapper:
+    # dask is imported here rather than at module level to keep `import bag_mp` cheap
+    from dask.distributed import get_client
+    from .client_wrapper import FutureWrapper
+
+    fut = get_client().submit(func, *args, **kwargs)
+    return FutureWrapper.from_future(fut)
+
+
+class _method_or_static:
+    """A method that, looked up on its class, is static_func instead. Keeps Class.method(...)
+    working for a former staticmethod."""
+
+    def __init__(self, method: Callable, static_func: Callable) -> None:
+        self.method = method
+        self.static_func = static_func
+        self.__doc__ = method.__doc__
+
+    def __get__(self, obj, objtype=None) -> Callable:
+        if obj is None:
+            return self.static_func
+        return self.method.__get__(obj, objtype)
+
+
+def _gen_cell_args(gen_lay, gen_sch, run_lvs, run_rcx, **kwargs) -> List[str]:
+    args = []
+    if not gen_lay:
+        args.append('--no-lay')
+    if not gen_sch:
+        args.append('--no-sch')
+    if run_lvs:
+        args.append('-v')
+    if run_rcx:
+        args.append('-x')
+    return args
+
+
+def _sim_cell_args(gen_cell, gen_wrapper, gen_tb, load_results, extract, run_sim,
+                   **kwargs) -> List[str]:
+    args = []
+    if not gen_cell:
+        args.append('--no-cell')
+    if not gen_wrapper:
+        args.append('--no-wrapper')
+    if not gen_tb:
+        args.append('--no-tb')
+    if load_results:
+        args.append('--load')
+    if extract:
+        args.append('-x')
+    if not run_sim:
+        args.append('--no-sim')
+    return args
+
+
+_stage_args = {
+    'gen_cell': _gen_cell_args,
+    'sim_cell': _sim_cell_args,
+    'meas_cell': _sim_cell_args,
 }
 
 
+def _requested_stages(gen_sch, gen_lay, run_lvs, run_rcx, **kwargs) -> List[str]:
+    return [stage for stage, enabled in zip(GEN_CELL_STAGES, (gen_sch, gen_lay, run_lvs, run_rcx))
+            if enabled]
+
+
+def _join_stages(output, *stage_outputs):
+    """Returns the result of a split gen_cell from its generation stage, the other stage
+    outputs are only waited for. Runs on the workers."""
+    return output
+
+
+def job_key(stage: str, specs, flags: Dict[str, Any]) -> str:
+    """
+    Returns the deterministic dask key of a job.
+
+    The key is a canonical digest of the stage, specs and stage flags (including bag_id), so
+    identical requests from any client or optimizer collapse onto a single task and share
+    its result. Arguments that do not affect what the BAG script runs, like dep, log_file
+    and the fields projection of sim_cell/meas_cell, are not part of flags.
+
+    Sharing includes failures: while any client still holds the future of a failed job,
+    submitting the same job again returns that future and its error. Call retry() on the
+    future to run it again, or give the job dask retries (see BagMP stage_options).
+    """
+    return f'{stage}-{digest((stage, specs, flags))}'
+
+
 class BagMP:
-    def __init__(self, interactive=False, verbose=False, **kwargs) -> None:
-        try:
-            client = get_client()
-            print(f'client loaded: {client}')
-        except ValueError:
-            create_client(**kwargs)
-            print(f'client created: {get_client()}')
+    # state that only lives on the client, dropped when the object is shipped to workers
+    _client_only_attrs = ('journal', '_published', 'admission', 'metrics_server', 'batcher',
+                          'tracer', '_spill_refs', '_spill_lock')
+
+    def __init__(self, interactive=False, verbose=False, scheduler_file=None,
+                 autostart=False, journal=None, owner=None, priority='normal',
+                 max_in_flight=None, spill_threshold=SPILL_THRESHOLD, profile=False,
+                 metrics_port=None, batch_size=None, batch_window=BATCH_WINDOW,
+                 stage_options=None, trace=None, artifact_store=None,
+                 artifact_max_bytes=None, **kwargs) -> None:
+        """
+        Parameters
+        ----------
+        interactive: bool
+            True to run the bag scripts through start_bag.sh -i.
+        verbose: bool
+            True to stream subprocess output instead of writing it to the log file.
+        scheduler_file: os.PathLike
+            scheduler file of a persistent cluster to attach to, defaults to
+            $BAG_MP_SCHEDULER_FILE. When neither is set a new Client(**kwargs) is created.
+        autostart: bool
+            True to start a persistent cluster if scheduler_file is not reachable.
+        journal: os.PathLike
+            optional journal directory. gen_cell/sim_cell/meas_cell jobs are recorded there
+            and reopening the same journal skips finished jobs, reattaches to jobs still
+            running on a persistent cluster and resubmits the rest.
+        owner: str
+            the fair-share owner of the jobs submitted through this object, defaults to the
+            user name.
+        priority: str
+            default priority class of submitted jobs: 'interactive', 'normal' or 'batch'.
+        max_in_flight: int
+            optional cap on the unfinished normal/batch jobs of owner, submissions block
+            until earlier jobs finish. Interactive jobs are never throttled.
+        spill_threshold: int
+            sim_cell/meas_cell dumps larger than this many bytes are not loaded, the job
+            returns a results.LazyResult handle instead and fields are read through it on
+            the worker. The dump is kept in $BAG_TEMP_DIR/spill until the job's future is
+            released. None to always load.
+        profile: Union[bool, os.PathLike]
+            True, or a directory, to profile gen_cell/sim_cell/meas_cell jobs and the BAG
+            processes they start, see profiling. True uses $BAG_TEMP_DIR/profiles, the
+            directory has to be reachable from the workers and the client.
+        metrics_port: int
+            optional local port serving the metrics in Prometheus text format at /metrics,
+            0 picks a free port. The metrics are always recorded, see metrics.snapshot.
+        batch_size: int
+            enables micro-batching: gen_cell/sim_cell/meas_cell jobs without dep of the same
+            stage, bag_id and io_format are grouped and run up to batch_size at a time in
+            one BAG process, see batching. Worth it for jobs that take less time than
+            starting BAG.
+        batch_window: float
+            seconds a partial micro-batch waits for more jobs before it runs.
+        stage_options: Dict[str, Dict[str, Any]]
+            dask submit options of the stages of a split gen_cell, keyed by stage name
+            ('gen_sch', 'gen_lay', 'run_lvs' or 'run_rcx'), e.g.
+            {'run_lvs': {'resources': {'calibre': 1}, 'retries': 2}}.
+        trace: os.PathLike
+            optional trace file recording stage, flags, submit/start/end times, worker and
+            resources of every job, for capacity planning with the simulator module. The
+            trace is completed from the scheduler's task stream on flush_trace.
+        artifact_store: Union[os.PathLike, artifacts.ArtifactStore]
+            shared directory of an artifact store, defaults to $BAG_MP_ARTIFACT_DIR. gen_cell
+            stages store what they generate there and restore it instead of running again
+            for the same specs and bag_id. sim_cell/meas_cell with gen_cell set pull the DUT
+            (with its extracted netlist when extract is set) from it and skip generating it.
+            Calls with use_artifacts=False run anyway.
+        artifact_max_bytes: int
+            size budget of the artifact store, least recently used entries are collected
+            beyond it.
+        kwargs:
+            passed to Client when no persistent cluster is used.
+        """
+        client = connect_client(scheduler_file, autostart=autostart, **kwargs)
+        if verbose:
+            print(f'client connected: {client}')
         self.bag_tmp_dir = os.environ.get('BAG_TEMP_DIR', None)
         self.interactive = interactive
         self.verbose = verbose
+        self.journal = None if journal is None else BatchJournal(journal)
+        # jobs published to the scheduler so that they survive this client
+        self._published = set(client.list_datasets()) if self.journal else set()
+        self.owner = default_owner() if owner is None else owner
+        self.priority = priority
+        self.admission = AdmissionController(max_in_flight)
+        self.spill_threshold = spill_threshold
+        self.spill_dir = None
+        if self.bag_tmp_dir is not None:
+            self.spill_dir = Path(self.bag_tmp_dir).resolve() / SPILL_DIRNAME
+        # futures of each job that may have spilled its result
+        self._spill_refs = Counter()
+        self._spill_lock = threading.Lock()
+        if profile is True:
+            profile = Path(self.bag_tmp_dir) / 'profiles'
+        self.profile_dir = Path(profile).resolve() if profile else None
+        metrics.JOBS.watch_tmp_dir(self.bag_tmp_dir)
+        # job run times come from the task stream
+        ensure_task_stream(client)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.start_http_server(metrics_port)
+        self.batcher = None
+        if batch_size:
+            self.batcher = MicroBatcher(self._submit_batch, batch_size, batch_window)
+        self.stage_options = {} if stage_options is None else stage_options
+        if isinstance(artifact_store, ArtifactStore):
+            self.artifacts = artifact_store
+        else:
+            self.artifacts = get_artifact_store(artifact_store, artifact_max_bytes)
+        self.tracer = None
+        if trace is not None:
+            self.tracer = TraceRecorder(trace)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        for attr in self._client_only_attrs:
+            state[attr] = None
+        return state
+
+    def _submit_job(self, stage: str, func: Callable, specs, priority=None, batch=True,
+                    submit_options: Optional[Dict[str, Any]] = None,
+                    **kwargs) -> FutureWrapper:
+        """Submits a gen_cell/sim_cell/meas_cell job under its deterministic key, journaling it
+        if a journal is open and adding it to a micro-batch if batching is enabled.
+        submit_options, e.g. resources or retries, are passed to Client.submit."""
+        from dask.distributed import get_client
+        from .client_wrapper import add_release_callback
+
+        owner = self.owner
+        priority_class = self.priority if priority is None else priority
+        dask_priority = self.admission.priority(owner, priority_class)
+
+        flags = {k: v for k, v in kwargs.items() if k not in ('dep', 'log_file')}
+        key = job_key(stage, specs, flags)
+        bag_id = kwargs.get('bag_id', '')
+        if self.journal is not None and self.journal.status(key) == 'done':
+            metrics.JOBS_CACHED.inc(stage=stage, bag_id=bag_id)
+            return _submit(load_result, self.journal.result_path(key), key=key,
+                           priority=dask_priority)
+
+        # concurrent jobs on the same specs with different flags must not share files
+        kwargs = dict(kwargs, tag=key)
+        args = (specs,)
+        batch_name = None
+        if self.profile_dir is not None:
+            args = (self.profile_dir / f'{key}.job.prof', func, specs)
+            func = run_profiled
+        elif (batch and self.batcher is not None and kwargs.get('dep', None) is None
+              and not submit_options and key not in get_client().futures):
+            # jobs already known to this client are shared through their key instead
+            group = (stage, bag_id, kwargs['io_format'])
+            batch_name, idx = self.batcher.add(group, key, specs, kwargs, dask_priority)
+            args = (batch_name, idx, func, specs)
+            func = await_batch
+
+        self.admission.acquire(owner, priority_class)
+        try:
+            if self.journal is None:
+                fut = _submit(func, *args, key=key, priority=dask_priority,
+                              **(submit_options or {}), **kwargs)
+            else:
+                fut = self._submit_journaled(key, stage, flags, func, args,
+                                             priority=dask_priority,
+                                             submit_options=submit_options, **kwargs)
+        except BaseException:
+            self.admission.release(owner)
+            if batch_name is not None:
+                self.batcher.release(batch_name)
+            raise
+        t0 = metrics.JOBS.submitted(key, stage, bag_id)
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.submitted(key, stage, flags, dep=kwargs.get('dep', None), bag_id=bag_id,
+                             priority=priority_class, owner=owner,
+                             resources=(submit_options or {}).get('resources', {}),
+                             batched=batch_name is not None)
+
+        def _released(status: str) -> None:
+            self.admission.release(owner)
+            metrics.JOBS.released(key, stage, bag_id, status, t0, timed=batch_name is None)
+            if batch_name is not None:
+                self.batcher.release(batch_name)
+            if tracer is not None:
+                tracer.released(key, status)
+
+        add_release_callback(fut, _released)
+        if stage != 'gen_cell' and self.spill_threshold is not None:
+            self._track_spill(fut, key)
+        return fut
 
-    def resolve_specs(self, specs, io_format, **kwargs):
+    def _track_spill(self, fut: FutureWrapper, key: str) -> None:
+        """Deletes the spilled result of job key once no future of it is left."""
+        with self._spill_lock:
+            self._spill_refs[key] += 1
+        weakref.finalize(fut, self._release_spill, key)
+
+    def _release_spill(self, key: str) -> None:
+        with self._spill_lock:
+            self._spill_refs[key] -= 1
+            if self._spill_refs[key] > 0:
+                return
+            del self._spill_refs[key]
+        remove_spilled(self.spill_dir, key)
+
+    def _project(self, fut: FutureWrapper, fields, priority=None) -> FutureWrapper:
+        """Submits the fields projection of a sim_cell/meas_cell job as a dependent task, so
+        that every projection of a design shares one simulation."""
+        from .client_wrapper import add_release_callback
+
+        priority_class = self.priority if priority is None else priority
+        # callables have no stable digest, dask keys them itself
+        key = None if callable(fields) else f'{fut.key}-fields-{digest(fields)}'
+        projected = _submit(project_output, fut, fields, key=key,
+                            priority=self.admission.last_priority(self.owner, priority_class))
+        # the job future lives as long as its projection, its release callback marks the end
+        # of the job
+        jobs = [fut]
+        add_release_callback(projected, lambda status: jobs.clear())
+        return projected
+
+    def _submit_journaled(self, key: str, stage: str, flags: Dict[str, Any], func: Callable,
+                          args, priority: int, submit_options: Optional[Dict[str, Any]] = None,
+                          **kwargs) -> FutureWrapper:
+        from dask.distributed import get_client
+        from .client_wrapper import FutureWrapper
+
+        client = get_client()
+        result_path = self.journal.result_path(key)
+        if key in self._published:
+            # still in flight on the cluster, e.g. submitted by a client that died
+            fut = FutureWrapper.from_future(client.get_dataset(key))
+        else:
+            fut = _submit(run_journaled, result_path, func, *args, key=key, priority=priority,
+                          **(submit_options or {}), **kwargs)
+            try:
+                client.publish_dataset(fut, name=key)
+            except KeyError:
+                # another client is running the same job and has already published it
+                pass
+            self._published.add(key)
+            self.journal.record(key, 'submitted', stage=stage, flags=flags,
+                                result=str(result_path))
+        fut.add_done_callback(lambda f: self._journal_done(key, f))
+        return fut
+
+    def _journal_done(self, key: str, fut: FutureWrapper) -> None:
+        if fut.status == 'finished':
+            # a spilled result is not journaled, it lives only as long as the future
+            done = self.journal.result_path(key).exists()
+            self.journal.record(key, 'done' if done else 'spilled')
+        elif fut.status == 'error':
+            self.journal.record(key, 'failed', error=repr(fut.exception()))
+        else:
+            self.journal.record(key, fut.status)
+        if key in self._published:
+            self._published.discard(key)
+            try:
+                fut.client.unpublish_dataset(key)
+            except KeyError:
+                # unpublished by another client sharing the job
+                pass
+
+    def _submit_batch(self, group: Tuple[str, str, str],
+                      jobs: List[Tuple[str, Any, Dict[str, Any]]], priority: int) -> FutureWrapper:
+        from .client_wrapper import add_release_callback
+
+        stage, bag_id, io_format = group
+        key = f'{stage}-batch-{digest((group, jobs))}'
+        submitted = time.time()
+        fut = _submit(self._run_batch, stage, bag_id, io_format, jobs, key=key,
+                      priority=priority)
+        tracer = self.tracer
+        # the jobs of a batch only wait for it, the batch task is what runs
+
+        def _released(status: str) -> None:
+            if status == 'finished':
+                metrics.JOBS.task_finished(key, stage, bag_id, submitted)
+            if tracer is not None:
+                tracer.released(key, status)
+
+        if tracer is not None:
+            tracer.submitted(key, stage, {}, bag_id=bag_id,
+                             members=[job_key for job_key, _, _ in jobs])
+        add_release_callback(fut, _released)
+        return fut
+
+    def _run_batch(self, stage: str, bag_id: str, io_format: str,
+                   jobs: List[Tuple[str, Any, Dict[str, Any]]]) -> List[Tuple[bool, Any]]:
+        """Runs a micro-batch of (key, specs, flags) jobs in one BAG process, returns an (ok,
+        result or error message) pair per job."""
+        io_cls = io_cls_dict[io_format]
+        bag_config = get_config_dict()[bag_id]
+        entries = []
+        results = [None] * len(jobs)
+        for idx, (key, specs, flags) in enumerate(jobs):
+            # jobs on the same specs with different flags must not share files
+            tmp_file, out_tmp_file = self.resolve_specs(specs, io_format, tag=key)
+            log_file = flags.get('log_file', None)
+            if stage == 'gen_cell':
+                log_path = self.get_log_fname(tmp_file) if log_file is None else log_file
+                # flags still hold the job's own log_file and dep
+                restored = self._restore_gen_cell(specs, **dict(flags, log_file=log_path))
+                if restored is not None:
+                    results[idx] = (True, restored[0])
+                    continue
+            else:
+                flags = dict(flags, gen_cell=self._pull_dut(specs, **flags))
+            entries.append(dict(
+                idx=idx,
+                script=str(bag_config[stage]),
+                specs=str(tmp_file),
+                dump=str(out_tmp_file),
+                args=_stage_args[stage](**flags),
+                log=str(self.get_log_fname(tmp_file) if log_file is None else log_file),
+                log_mode='w' if log_file is None else 'a',
+            ))
+        if not entries:
+            return results
+        tmp_dir = Path(self.bag_tmp_dir).resolve()
+        batch_file = tmp_dir / f'batch_{digest(entries)}.{io_format}'
+        status_file = tmp_dir / f'{batch_file.stem}_out.{io_format}'
+        io_cls.save(entries, batch_file)
+        envs = self._get_env_vars(bag_config['envs'])
+        self.run_script(BATCH_RUNNER, batch_file, status_file, io_format, [],
+                        bag_config['work_dir'], env=envs)
+
+        for entry, status in zip(entries, io_cls.load(status_file)):
+            key, specs, flags = jobs[entry['idx']]
+            if not status['ok']:
+                print(f'[failure] {entry["script"]} {entry["specs"]}')
+                print(f'log: {entry["log"]}')
+                results[entry['idx']] = (False, f'python subprocess failed ({status["error"]}), '
+                                                f'log: {entry["log"]}')
+                continue
+            try:
+                if stage == 'gen_cell':
+                    self._store_gen_cell(specs, Path(entry['dump']), **flags)
+                output = self._load_stage_output(stage, Path(entry['dump']),
+                                                 Path(entry['log']), key=key, **flags)
+            except Exception as e:
+                results[entry['idx']] = (False, repr(e))
+            else:
+                results[entry['idx']] = (True, output)
+        return results
+
+    def _artifact_paths(self, specs, stage: str, bag_id: str) -> List[Path]:
+        bag_config = get_config_dict()[bag_id]
+        fields = {k: v for k, v in specs.items() if isinstance(v, str)}
+        paths = []
+        for template in bag_config.get('artifacts', {}).get(stage, []):
+            try:
+                paths.append(Path(bag_config['work_dir']) / template.format(**fields))
+            except (KeyError, IndexError):
+                continue
+        return paths
+
+    def _restore_artifacts(self, specs, stages: List[str],
+                           bag_id: str) -> Optional[Dict[str, Dict[str, Path]]]:
+        """Pulls the artifacts of stages for specs into work_dir, None unless all of them
+        are in the store."""
+        keys = [ArtifactStore.key(specs, stage, bag_id) for stage in stages]
+        if self.artifacts is None or not stages or not all(map(self.artifacts.has, keys)):
+            return None
+        work_dir = get_config_dict()[bag_id]['work_dir']
+        restored = {}
+        for stage, key in zip(stages, keys):
+            files = self.artifacts.restore(key, work_dir)
+            if files is None:
+                return None
+            restored[stage] = files
+        return restored
+
+    def _restore_gen_cell(self, specs, log_file, gen_lay, gen_sch, run_lvs, run_rcx, bag_id,
+                          io_format, use_artifacts=True, **kwargs) -> Optional[Tuple[Any]]:
+        """Returns a 1-tuple with what _gen_cell would return if every stage could be
+        restored from the artifact store, None otherwise."""
+        if not use_artifacts:
+            return None
+        stages = _requested_stages(gen_sch, gen_lay, run_lvs, run_rcx)
+        restored = self._restore_artifacts(specs, stages, bag_id)
+        if restored is None:
+            return None
+        with open(log_file, 'a') as log_f:
+            log_f.write(f'restored {", ".join(stages)} from {self.artifacts}\n')
+        print(f'[restored] {", ".join(stages)} of {log_file}')
+        if gen_sch or gen_lay:
+            output = restored['gen_lay' if gen_lay else 'gen_sch'][OUTPUT_NAME]
+            return ((io_cls_dict[io_format].load(output), Path(log_file)),)
+        return (None,)
+
+    def _store_gen_cell(self, specs, out_tmp_file: Path, gen_lay, gen_sch, run_lvs, run_rcx,
+                        bag_id, **kwargs) -> None:
+        if self.artifacts is None:
+            return
+        for stage in _requested_stages(gen_sch, gen_lay, run_lvs, run_rcx):
+            paths = self._artifact_paths(specs, stage, bag_id)
+            if not any(path.exists() for path in paths):
+                # nothing to reuse, a later run must not take this as a hit
+                continue
+            output = out_tmp_file if stage in ('gen_sch', 'gen_lay') else None
+            self.artifacts.put(ArtifactStore.key(specs, stage, bag_id), paths,
+                               get_config_dict()[bag_id]['work_dir'], output=output,
+                               bag_id=bag_id)
+
+    def _pull_dut(self, specs, gen_cell, extract, bag_id, use_artifacts=True, **kwargs) -> bool:
+        """Restores the DUT of a sim_cell/meas_cell job that asks for gen_cell from the
+        artifact store, returns whether the job still has to generate it."""
+        if not gen_cell or not use_artifacts:
+            # e.g. the DUT was just generated by the gen_cell job this one depends on
+            return gen_cell
+        stages = ['gen_sch', 'run_rcx'] if extract else ['gen_sch']
+        if self._restore_artifacts(specs, stages, bag_id) is not None:
+            return False
+        return gen_cell
+
+    def _load_stage_output(self, stage: str, out_tmp_file: Path, updated_log: Path, io_format,
+                           key=None, **flags):
+        """Returns what _gen_cell/_sim_cell/_meas_cell return after running the script, key
+        names a spilled result."""
+        if stage == 'gen_cell':
+            if flags['gen_sch'] or flags['gen_lay']:
+                return io_cls_dict[io_format].load(out_tmp_file), updated_log
+            return None
+        if flags['load_results'] or flags['run_sim']:
+            return (load_output(out_tmp_file, io_format, None, self.spill_threshold, key=key,
+                                spill_dir=self.spill_dir), updated_log)
+        return updated_log
+
+    def flush_trace(self) -> int:
+        """Writes the trace records of the jobs released so far, returns how many."""
+        if self.tracer is None:
+            raise ValueError('tracing is not enabled, create BagMP with trace=<file>')
+        return self.tracer.flush()
+
+    def profile_client(self, name: str = 'client'):
+        """Context manager profiling client-side code into the profile directory."""
+        if self.profile_dir is None:
+            raise ValueError('profiling is not enabled, create BagMP with profile=True')
+        return profile_block(self.profile_dir / f'{name}.prof')
+
+    def profile_report(self, kind: str = 'all'):
+        """
+        Aggregates the profiles collected so far.
+
+        Parameters
+        ----------
+        kind: str
+            'jobs' for the orchestration on the workers, 'bag' for the BAG child processes,
+            'client' for profile_client blocks, or 'all'.
+
+        Returns
+        -------
+        stats: Optional[pstats.Stats]
+            the merged stats, None when no profile was found. profiling.format_report turns
+            it into text.
+        """
+        if self.profile_dir is None:
+            raise ValueError('profiling is not enabled, create BagMP with profile=True')
+        return collect_profiles(self.profile_dir, kind)
+
+    def resolve_specs(self, specs, io_format, tag='', **kwargs):
         io_cls = io_cls_dict[io_format]
         tmp_dir = Path(self.bag_tmp_dir).resolve()
         const_specs = to_immutable(specs)
-        tmp_file = tmp_dir / f'specs_{hash(const_specs)}.{io_format}'
+        # tag keeps the files of jobs running concurrently on the same specs apart
+        suffix = f'_{tag}' if tag else ''
+        tmp_file = tmp_dir / f'specs_{hash(const_specs)}{suffix}.{io_format}'
         out_tmp_file = tmp_dir / f'{tmp_file.stem}_out.{io_format}'
         io_cls.save(specs, tmp_file, **kwargs)
         return tmp_file, out_tmp_file
@@ -95,9 +673,9 @@ class BagMP:
         with open(log_file, open_mode) as log_f:
             print(f'[running] {" ".join(cmd)}')
             if self.verbose:
-                exit_code = subprocess.call(cmd, timeout=PROCESS_TIMEOUT, cwd=cwd, env=env)
+                exit_code = run_cancellable(cmd, timeout=PROCESS_TIMEOUT, cwd=cwd, env=env)
             else:
-                exit_code = subprocess.call(cmd, stdout=log_f, stderr=log_f,
+                exit_code = run_cancellable(cmd, stdout=log_f, stderr=log_f,
                                             timeout=PROCESS_TIMEOUT, cwd=cwd, env=env)
         if exit_code != 0:
             print(f'[failure] {" ".join(cmd)}')
@@ -110,23 +688,22 @@ class BagMP:
     def _get_env_vars(self, updated_envs: Dict[str, str]):
         envs = os.environ.copy()
         envs.update(updated_envs)
+        # makes the BAG child dump its own profile when running a profiled job
+        envs.update(get_child_env())
         return envs
 
     def _gen_cell(self, specs, dep, gen_lay, gen_sch, run_lvs, run_rcx,
-                  log_file, bag_id, io_format, **kwargs):
+                  log_file, bag_id, io_format, tag='', use_artifacts=True, **kwargs):
         io_cls = io_cls_dict[io_format]
-        tmp_file, out_tmp_file = self.resolve_specs(specs, io_format)
-        args = []
-        if not gen_lay:
-            args.append('--no-lay')
-        if not gen_sch:
-            args.append('--no-sch')
-        if run_lvs:
-            args.append('-v')
-        if run_rcx:
-            args.append('-x')
+        tmp_file, out_tmp_file = self.resolve_specs(specs, io_format, tag=tag)
+        restored = self._restore_gen_cell(
+            specs, self.get_log_fname(tmp_file) if log_file is None else log_file,
+            gen_lay, gen_sch, run_lvs, run_rcx, bag_id, io_format, use_artifacts)
+        if restored is not None:
+            return restored[0]
+        args = _gen_cell_args(gen_lay, gen_sch, run_lvs, run_rcx)
 
-        bag_config = config_dict[bag_id]
+        bag_config = get_config_dict()[bag_id]
         cwd = bag_config['work_dir']
         envs = self._get_env_vars(bag_config['envs'])
         updated_log = self.run_script(bag_config['gen_cell'],
@@ -137,30 +714,19 @@ class BagMP:
                                       cwd,
                                       env=envs,
                                       log_file=log_file)
+        self._store_gen_cell(specs, out_tmp_file, gen_lay, gen_sch, run_lvs, run_rcx, bag_id)
 
         if gen_sch or gen_lay:
             # return sch_params
             return io_cls.load(out_tmp_file, **kwargs), updated_log
 
     def _sim_cell(self, specs, dep, gen_cell, gen_wrapper, gen_tb, load_results, extract,
-                  run_sim, log_file, bag_id, io_format, **kwargs):
-        io_cls = io_cls_dict[io_format]
-        tmp_file, out_tmp_file = self.resolve_specs(specs, io_format)
-        args = []
-        if not gen_cell:
-            args.append('--no-cell')
-        if not gen_wrapper:
-            args.append('--no-wrapper')
-        if not gen_tb:
-            args.append('--no-tb')
-        if load_results:
-            args.append('--load')
-        if extract:
-            args.append('-x')
-        if not run_sim:
-            args.append('--no-sim')
-
-        bag_config = config_dict[bag_id]
+                  run_sim, log_file, bag_id, io_format, use_artifacts=True, tag='', **kwargs):
+        tmp_file, out_tmp_file = self.resolve_specs(specs, io_format, tag=tag)
+        gen_cell = self._pull_dut(specs, gen_cell, extract, bag_id, use_artifacts)
+        args = _sim_cell_args(gen_cell, gen_wrapper, gen_tb, load_results, extract, run_sim)
+
+        bag_config = get_config_dict()[bag_id]
         cwd = bag_config['work_dir']
         envs = self._get_env_vars(bag_config['envs'])
         updated_log = self.run_script(bag_config['sim_cell'],
@@ -174,29 +740,20 @@ class BagMP:
 
         if load_results or run_sim:
             # return sim results
-            return io_cls.load(out_tmp_file, **kwargs), updated_log
+            return load_output(out_tmp_file, io_format, None, self.spill_threshold,
+                               key=tag or None, spill_dir=self.spill_dir,
+                               **kwargs), updated_log
         else:
             return updated_log
 
     def _meas_cell(self, specs, dep, gen_cell, gen_wrapper, gen_tb, load_results, extract,
-                   run_sim, log_file, bag_id, io_format, **kwargs):
-        io_cls = io_cls_dict[io_format]
-        tmp_file, out_tmp_file = self.resolve_specs(specs, io_format)
-        args = []
-        if not gen_cell:
-            args.append('--no-cell')
-        if not gen_wrapper:
-            args.append('--no-wrapper')
-        if not gen_tb:
-            args.append('--no-tb')
-        if load_results:
-            args.append('--load')
-        if extract:
-            args.append('-x')
-        if not run_sim:
-            args.append('--no-sim')
-
-        bag_config = config_dict[bag_id]
+                   run_sim, log_file, bag_id, io_format, use_artifacts=True, tag='',
+                   **kwargs):
+        tmp_file, out_tmp_file = self.resolve_specs(specs, io_format, tag=tag)
+        gen_cell = self._pull_dut(specs, gen_cell, extract, bag_id, use_artifacts)
+        args = _sim_cell_args(gen_cell, gen_wrapper, gen_tb, load_results, extract, run_sim)
+
+        bag_config = get_config_dict()[bag_id]
         cwd = bag_config['work_dir']
         envs = self._get_env_vars(bag_config['envs'])
         updated_log = self.run_script(bag_config['meas_cell'],
@@ -210,23 +767,115 @@ class BagMP:
 
         if load_results or run_sim:
             # return meas results
-            return io_cls.load(out_tmp_file, **kwargs), updated_log
+            return load_output(out_tmp_file, io_format, None, self.spill_threshold,
+                               key=tag or None, spill_dir=self.spill_dir,
+                               **kwargs), updated_log
         else:
             return updated_log
 
     def gen_cell(self, specs, dep=None, gen_lay=False, gen_sch=False,
                  run_lvs=False, run_rcx=False, log_file=None,
-                 bag_id='BAG2', io_format='yaml'):
-        client = get_client()
-        fut = client.submit(self._gen_cell, specs, dep=dep, gen_lay=gen_lay,
-                            gen_sch=gen_sch, run_lvs=run_lvs, run_rcx=run_rcx,
-                            log_file=log_file, bag_id=bag_id,
-                            io_format=io_format)
-        return FutureWrapper.from_future(fut)
+                 bag_id='BAG2', io_format='yaml', priority=None, batch=True, split=False,
+                 stage_options=None, use_artifacts=True):
+        """
+        submits a generation job to the queue of workers
+        Parameters
+        ----------
+        specs: Dict[str, Any]
+            specification dictionary
+        dep: Any
+            A dummy variable for specifying explicit dependencies.
+        gen_lay: bool
+            True to generate layout.
+        gen_sch: bool
+            True to generate schematic.
+        run_lvs: bool
+            True to run LVS.
+        run_rcx: bool
+            True to run RCX.
+        log_file: bool
+            The location of the log file.
+        bag_id:
+            Look at the key words in sim_cell_scripts. Those are the valid key words.
+        io_format
+            yaml or pickle. It determines the interface format to external jobs.
+        priority: str
+            priority class of this job, 'interactive', 'normal' or 'batch'. Defaults to the
+            priority given to BagMP.
+        batch: bool
+            False to never run this job in a micro-batch, see BagMP batch_size.
+        split: bool
+            True to run each requested stage as its own task: schematic and layout
+            generation in parallel, then LVS, then RCX. Every stage is retried and
+            scheduled on its own, see stage_options. This needs a gen_cell script that
+            can run LVS/RCX on previously generated views, and a schematic that does not
+            need the layout's sch_params.
+        stage_options: Dict[str, Dict[str, Any]]
+            per-call dask submit options of the split stages, on top of the ones given to
+            BagMP.
+        use_artifacts: bool
+            False to run every stage even if its outputs are in the artifact store, e.g.
+            after the generator code changed. The new outputs replace the stored ones.
+        Returns
+        -------
+        FutureWrapper[Optional[Tuple[Any, Path]]]
+        The dumped sch_params and the log file if something was generated. When split,
+        they come from the layout stage if gen_lay is set.
+        """
+        kwargs = dict(dep=dep, gen_lay=gen_lay, gen_sch=gen_sch, run_lvs=run_lvs,
+                      run_rcx=run_rcx, log_file=log_file, bag_id=bag_id, io_format=io_format,
+                      use_artifacts=use_artifacts)
+        if split:
+            return self._gen_cell_stages(specs, priority, stage_options, **kwargs)
+        return self._submit_job('gen_cell', self._gen_cell, specs, priority=priority,
+                                batch=batch, **kwargs)
+
+    def _gen_cell_stages(self, specs, priority, stage_options, dep, gen_lay, gen_sch,
+                         run_lvs, run_rcx, **kwargs) -> FutureWrapper:
+        """Submits gen_cell as a graph of per-stage jobs joined into one future."""
+        from .client_wrapper import add_release_callback
+
+        options = {stage: dict(self.stage_options.get(stage, {})) for stage in GEN_CELL_STAGES}
+        for stage, stage_opts in (stage_options or {}).items():
+            options[stage].update(stage_opts)
+
+        def _stage(stage: str, stage_dep, **flags) -> FutureWrapper:
+            stage_flags = dict(gen_lay=False, gen_sch=False, run_lvs=False, run_rcx=False)
+            stage_flags.update(flags)
+            return self._submit_job(stage, self._gen_cell, specs, priority=priority,
+                                    batch=False, submit_options=options[stage], dep=stage_dep,
+                                    tag=stage, **stage_flags, **kwargs)
+
+        generated = []
+        if gen_sch:
+            generated.append(_stage('gen_sch', dep, gen_sch=True))
+        if gen_lay:
+            generated.append(_stage('gen_lay', dep, gen_lay=True))
+        checks = []
+        if run_lvs:
+            checks.append(_stage('run_lvs', generated or dep, run_lvs=True))
+        if run_rcx:
+            checks.append(_stage('run_rcx', checks[-1:] or generated or dep, run_rcx=True))
+
+        flags = dict(gen_lay=gen_lay, gen_sch=gen_sch, run_lvs=run_lvs, run_rcx=run_rcx,
+                     bag_id=kwargs['bag_id'], io_format=kwargs['io_format'],
+                     use_artifacts=kwargs['use_artifacts'])
+        priority_class = self.priority if priority is None else priority
+        output = generated[-1] if generated else None
+        key = f'{job_key("gen_cell", specs, flags)}-stages'
+        if self.tracer is not None:
+            self.tracer.alias(key, [fut.key for fut in generated + checks])
+        fut = _submit(_join_stages, output, *generated, *checks, key=key,
+                      priority=self.admission.last_priority(self.owner, priority_class))
+        # the stage futures live as long as the join, dropping the join cancels the stages
+        stages = generated + checks
+        add_release_callback(fut, lambda status: stages.clear())
+        return fut
 
     def sim_cell(self, specs, dep=None, gen_cell=False, gen_wrapper=False,
                  gen_tb=False, load_results=False, extract=True, run_sim=False, log_file=None,
-                 bag_id='BAG2', io_format='yaml'):
+                 bag_id='BAG2', io_format='yaml', priority=None, fields=None, batch=True,
+                 use_artifacts=True):
         """
         submits a simulation job to the queue of workers
         Parameters
@@ -257,33 +906,53 @@ class BagMP:
             Look at the key words in sim_cell_scripts. Those are the valid key words.
         io_format
             yaml or pickle. It determines the interface format to external jobs.
+        priority: str
+            priority class of this job, 'interactive', 'normal' or 'batch'. Defaults to the
+            priority given to BagMP.
+        fields:
+            optional projection applied on the worker before the results are sent back:
+            a sequence of keys (tuples of keys address nested values), giving a dictionary
+            from field to value, or a callable reducing the results. The projection runs as a
+            dependent task, so projections of the same design share one simulation. Without
+            it, results larger than BagMP.spill_threshold come back as a results.LazyResult.
+        batch: bool
+            False to never run this job in a micro-batch, see BagMP batch_size.
+        use_artifacts: bool
+            False to generate the cell even if it is in the artifact store. With gen_cell
+            unset the DUT is never pulled from the store.
         Returns
         -------
         FutureWrapper[Tuple[Any, Path]]
         The results of the simulation as well as the log file.
         """
-        client = get_client()
-        fut = client.submit(self._sim_cell, specs, dep=dep, gen_cell=gen_cell,
-                            gen_wrapper=gen_wrapper,  gen_tb=gen_tb, load_results=load_results,
-                            run_sim=run_sim, log_file=log_file, extract=extract,
-                            bag_id=bag_id, io_format=io_format)
-        return FutureWrapper.from_future(fut)
+        fut = self._submit_job('sim_cell', self._sim_cell, specs, priority=priority,
+                               batch=batch, dep=dep,
+                               gen_cell=gen_cell, gen_wrapper=gen_wrapper, gen_tb=gen_tb,
+                               load_results=load_results, run_sim=run_sim, log_file=log_file,
+                               extract=extract, bag_id=bag_id, io_format=io_format,
+                               use_artifacts=use_artifacts)
+        if fields is None or not (load_results or run_sim):
+            return fut
+        return self._project(fut, fields, priority)
 
     def meas_cell(self, specs, dep=None, gen_cell=False, gen_wrapper=False,
                   gen_tb=False, load_results=False, extract=True, run_sim=False, log_file=None,
-                  bag_id='BAG2', io_format='yaml'):
-        client = get_client()
-        fut = client.submit(self._meas_cell, specs, dep=dep, gen_cell=gen_cell,
-                            gen_wrapper=gen_wrapper, gen_tb=gen_tb, load_results=load_results,
-                            run_sim=run_sim, log_file=log_file, extract=extract,
-                            bag_id=bag_id, io_format=io_format)
-        return FutureWrapper.from_future(fut)
+                  bag_id='BAG2', io_format='yaml', priority=None, fields=None, batch=True,
+                  use_artifacts=True):
+        fut = self._submit_job('meas_cell', self._meas_cell, specs, priority=priority,
+                               batch=batch, dep=dep,
+                               gen_cell=gen_cell, gen_wrapper=gen_wrapper, gen_tb=gen_tb,
+                               load_results=load_results, run_sim=run_sim, log_file=log_file,
+                               extract=extract, bag_id=bag_id, io_format=io_format,
+                               use_artifacts=use_artifacts)
+        if fields is None or not (load_results or run_sim):
+            return fut
+        return self._project(fut, fields, priority)
 
     def design_cell(self):
         pass
 
-    @staticmethod
-    def submit(func: Callable, *args, **kwargs) -> FutureWrapper:
+    def submit(self, func: Callable, *args, priority=None, **kwargs) -> FutureWrapper:
         """
         Convenience function to submit arbitrary jobs to the client
         Parameters
@@ -292,15 +961,33 @@ class BagMP:
             The function has to be serializable
         args:
             optional arg list, could be FutureWrappers or any other serializable object
+        priority: str
+            priority class of this job, 'interactive', 'normal' or 'batch'. Defaults to the
+            priority given to BagMP.
         kwargs:
             optional keyword argument list, could be FutureWrappers or any other serializable object
 
         args and kwargs are parameters of the callable
 
+        BagMP.submit(func, ...), called on the class, submits without priority classes or
+        admission control, kwargs then go to Client.submit.
+
         Returns
         -------
         results of the job as FutureWrapper objects
         """
-        client = get_client()
-        fut = client.submit(func, *args, **kwargs)
-        return FutureWrapper.from_future(fut)
+        from .client_wrapper import add_release_callback
+
+        owner = self.owner
+        priority_class = self.priority if priority is None else priority
+        dask_priority = self.admission.priority(owner, priority_class)
+        self.admission.acquire(owner, priority_class)
+        try:
+            fut = _submit(func, *args, priority=dask_priority, **kwargs)
+        except BaseException:
+            self.admission.release(owner)
+            raise
+        add_release_callback(fut, lambda status: self.admission.release(owner))
+        return fut
+
+    submit = _method_or_static(submit, _submit)
@@ -3,7 +3,6 @@ import os
 import string
 
 import pickle
-import yaml
 
 
 class Pickle:
@@ -28,11 +27,13 @@ class Yaml:
     """
     @staticmethod
     def save(obj: Any, file, **kwargs) -> None:
+        import yaml
         with open(file, 'w') as f:
             yaml.dump(obj, f)
 
     @staticmethod
     def load(file, **kwargs) -> Any:
+        import yaml
         with open(file, 'r') as f:
             return yaml.load(f, Loader=yaml.Loader)
 
@@ -50,12 +51,19 @@ class Yaml:
         table : Dict[str, Any]
             the yaml file as a dictionary.
         """
+        import yaml
         content = read_file(file)
         # substitute environment variables
         content = string.Template(content).substitute(os.environ)
         return yaml.load(content, Loader=yaml.Loader)
 
 
+io_cls_dict = {
+    'pickle': Pickle,
+    'yaml': Yaml,
+}
+
+
 def read_file(fname) -> str:
     """Read the given file and return content as string.
 
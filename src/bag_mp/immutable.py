@@ -6,7 +6,9 @@ from __future__ import annotations
 from typing import TypeVar, Any, Generic, Dict, Iterable, Tuple, Union, Optional, overload
 
 import sys
+import json
 import bisect
+import hashlib
 from collections import Hashable, Mapping, Sequence
 
 T = TypeVar('T')
@@ -192,3 +194,34 @@ def to_immutable(obj: Any) -> ImmutableType:
         return ImmutableSortedDict(obj)
 
     raise ValueError('Cannot convert the following object to immutable type: {}'.format(obj))
+
+
+def _canonical(obj: Any) -> Any:
+    # every value is tagged with its kind, so e.g. a dict and a list of pairs never collide
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return [type(obj).__name__, obj]
+    if isinstance(obj, Mapping):
+        items = [[_canonical(k), _canonical(v)] for k, v in obj.items()]
+        return ['dict', sorted(items, key=lambda item: json.dumps(item[0]))]
+    if isinstance(obj, tuple):
+        return ['tuple', [_canonical(v) for v in obj]]
+    if isinstance(obj, (list, ImmutableList)):
+        return ['list', [_canonical(v) for v in obj]]
+    if isinstance(obj, (set, frozenset)):
+        return ['set', sorted((_canonical(v) for v in obj), key=json.dumps)]
+    if isinstance(obj, bytes):
+        return ['bytes', obj.hex()]
+    return ['repr', f'{type(obj).__module__}.{type(obj).__qualname__}', repr(obj)]
+
+
+def digest(obj: Any) -> str:
+    """Returns a canonical hex digest of the given object.
+
+    Unlike hash(), the digest is stable across processes and hosts: dictionaries and sets
+    are ordered canonically and every value is tagged with its type before the JSON
+    encoding is hashed with sha1, so a dictionary and a list of its items differ. Other
+    objects are digested through their type and repr, which must then be deterministic
+    (e.g. not contain an id).
+    """
+    encoded = json.dumps(_canonical(obj), separators=(',', ':'))
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
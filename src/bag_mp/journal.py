@@ -0,0 +1,106 @@
+"""Write-ahead journal of submitted jobs, used to resume a batch after the client dies.
+
+Every journaled job gets one entry keyed by the digest of its stage, specs and flags. The
+client appends status changes to journal.jsonl and workers write finished results to
+results/<key>.pkl next to it, so the journal directory has to be visible to both, like
+BAG_TEMP_DIR. A result file is authoritative: a job whose result file exists is done even
+if the client died before it could record that. Spilled results (results.LazyResult) are
+not stored, their dump is deleted with the job's future, so such jobs run again on resume.
+"""
+
+from typing import Dict, Any, Optional, Callable
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+from .file import Pickle
+from .results import is_spilled
+
+JOURNAL_FNAME = 'journal.jsonl'
+RESULTS_DIRNAME = 'results'
+
+
+def load_result(result_path: os.PathLike) -> Any:
+    """Loads a journaled result, runs on the workers."""
+    return Pickle.load(result_path)
+
+
+def run_journaled(result_path: os.PathLike, func: Callable, *args, **kwargs) -> Any:
+    """Runs func and atomically stores its result at result_path, runs on the workers."""
+    result = func(*args, **kwargs)
+    if is_spilled(result):
+        return result
+    result_path = Path(result_path)
+    tmp_path = result_path.with_name(f'.{result_path.name}.{os.getpid()}.tmp')
+    Pickle.save(result, tmp_path)
+    os.replace(tmp_path, result_path)
+    return result
+
+
+class BatchJournal:
+    """
+    An append-only journal of job submissions and their status.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        the journal directory, created if it does not exist and replayed if it does.
+    """
+
+    def __init__(self, path: os.PathLike) -> None:
+        self.root = Path(path).resolve()
+        self.results_dir = self.root / RESULTS_DIRNAME
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self._log_path = self.root / JOURNAL_FNAME
+        self._lock = threading.Lock()
+        self._entries = self._replay()
+
+    def _replay(self) -> Dict[str, Dict[str, Any]]:
+        entries: Dict[str, Dict[str, Any]] = {}
+        if not self._log_path.exists():
+            return entries
+        with open(self._log_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn last line of a crashed client
+                    continue
+                entries.setdefault(record['key'], {}).update(record)
+        return entries
+
+    def record(self, key: str, status: str, **info: Any) -> None:
+        """Appends a status change of job key and flushes it to disk."""
+        record = dict(key=key, status=status, time=time.time(), **info)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self._log_path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._entries.setdefault(key, {}).update(record)
+
+    def result_path(self, key: str) -> Path:
+        return self.results_dir / f'{key}.pkl'
+
+    def status(self, key: str) -> Optional[str]:
+        """Returns 'done', the last recorded status, or None for unknown jobs."""
+        if self.result_path(key).exists():
+            return 'done'
+        entry = self._entries.get(key, None)
+        return None if entry is None else entry['status']
+
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._entries.items()}
+
+    def summary(self) -> Dict[str, int]:
+        """Returns the number of jobs in each status."""
+        counts: Dict[str, int] = {}
+        for key in self.entries():
+            status = self.status(key)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
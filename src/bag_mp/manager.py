@@ -1,30 +1,84 @@
-from typing import Dict, Any, Sequence, List, Union
+from __future__ import annotations
+
+from typing import (
+    Dict, Any, Sequence, List, Union, Optional, Callable, Tuple, TYPE_CHECKING
+)
 
 import abc
+import bisect
 from .core import BagMP
-from .client_wrapper import synchronize, FutureWrapper, get_results
+from .scheduling import default_owner
 from pathlib import Path
 from .file import read_file
-from jinja2 import Template
-import yaml
 import os
 
+if TYPE_CHECKING:
+    from .client_wrapper import FutureWrapper
+
 
 class EvalTemplate:
     def __init__(self, temp_path: os.PathLike):
         self._path: Path = Path(temp_path).resolve()
         self.content: str = read_file(self._path)
+        from jinja2 import Template
         self.jinja_temp = Template(self.content)
 
     def render_plain(self, params: Dict[str, Any]) -> str:
         return self.jinja_temp.render(**params)
 
     def render_yaml(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        import yaml
         yaml_content = self.render_plain(params)
         specs = yaml.load(yaml_content, Loader=yaml.Loader)
         return specs
 
 
+class _TopKGate:
+    """
+    Streams a top-k selection: each item is admitted or rejected as soon as its membership
+    in the final top-k (higher score is better) is certain, without waiting for the rest.
+
+    An item whose number of strictly better seen items plus the number of items still
+    outstanding is below k is guaranteed a place; one with k or more better items is out.
+    At most k items are undecided at any time.
+    """
+
+    def __init__(self, k: int, n_total: int) -> None:
+        self.k = k
+        self.outstanding = n_total
+        self._seen: List[Tuple[float, int]] = []
+        self._undecided: List[Tuple[float, int]] = []
+
+    def _n_better(self, item: Tuple[float, int]) -> int:
+        # ties are broken by submission index, earlier wins
+        return len(self._seen) - bisect.bisect_right(self._seen, item)
+
+    def update(self, idx: int, score: Optional[float]) -> Tuple[List[int], List[int]]:
+        """Records the score of item idx (None for failed items) and returns the
+        (admitted, rejected) indices decided by this update."""
+        self.outstanding -= 1
+        rejected = []
+        if score is None:
+            rejected.append(idx)
+        else:
+            item = (score, -idx)
+            bisect.insort(self._seen, item)
+            self._undecided.append(item)
+
+        admitted = []
+        undecided = []
+        for item in self._undecided:
+            n_better = self._n_better(item)
+            if n_better + self.outstanding < self.k:
+                admitted.append(-item[1])
+            elif n_better >= self.k:
+                rejected.append(-item[1])
+            else:
+                undecided.append(item)
+        self._undecided = undecided
+        return admitted, rejected
+
+
 class FlowManager(abc.ABC):
     def __init__(self, temp_fname, *args, **kwargs):
         self.template = self._get_template(temp_fname)
@@ -32,10 +86,21 @@ class FlowManager(abc.ABC):
         interactive = kwargs.pop('interactive', False)
         verbose = kwargs.pop('verbose', False)
         processes = kwargs.pop('processes', False)
-        self.prj = BagMP(interactive=interactive, verbose=verbose, processes=processes)
+        scheduler_file = kwargs.pop('scheduler_file', None)
+        autostart = kwargs.pop('autostart', False)
+        journal = kwargs.pop('journal', None)
+        # each flow gets its own fair share unless an owner is given
+        owner = kwargs.pop('owner', f'{default_owner()}/{type(self).__name__}-{id(self):x}')
+        priority = kwargs.pop('priority', 'batch')
+        max_in_flight = kwargs.pop('max_in_flight', None)
+        # the rest, e.g. metrics_port, trace or batch_size, is for BagMP too
+        self.prj = BagMP(interactive=interactive, verbose=verbose, scheduler_file=scheduler_file,
+                         autostart=autostart, journal=journal, owner=owner, priority=priority,
+                         max_in_flight=max_in_flight, processes=processes, **kwargs)
 
     @staticmethod
     def get_results(results: List[FutureWrapper]) -> Any:
+        from .client_wrapper import synchronize
         synchronize(results)
         cleared_results = []
         for job_res in results:
@@ -48,6 +113,7 @@ class FlowManager(abc.ABC):
 
     @staticmethod
     def sync(results: Union[List[FutureWrapper], FutureWrapper]) -> Any:
+        from .client_wrapper import synchronize
         return synchronize(results)
 
     def render(self, params: Dict[str, Any]) -> Dict[str, Any]:
@@ -61,3 +127,114 @@ class FlowManager(abc.ABC):
     def batch_evaluate(self, batch_of_designs: Sequence[Dict[str, Any]], sync=False) \
             -> Sequence[Any]:
         raise NotImplementedError
+
+    def screen_design(self, design: Dict[str, Any]) -> FutureWrapper:
+        """
+        Submits the cheap screening stage of a design, a schematic simulation by default.
+        Override to change how the screening specs are produced or simulated.
+
+        Returns
+        -------
+        FutureWrapper[Tuple[Any, Path]]
+            the schematic simulation results and the log file.
+        """
+        specs = self.render(design)
+        return self.prj.sim_cell(specs, gen_cell=True, gen_wrapper=True, gen_tb=True,
+                                 run_sim=True, extract=False)
+
+    def evaluate_design(self, design: Dict[str, Any], screen_result: Any) -> FutureWrapper:
+        """
+        Submits the expensive stage of a design that passed screening: layout generation,
+        LVS/RCX and post-layout simulation by default.
+
+        Parameters
+        ----------
+        design: Dict[str, Any]
+            the design parameters.
+        screen_result: Any
+            the results returned by the screening stage of this design.
+
+        Returns
+        -------
+        FutureWrapper[Tuple[Any, Path]]
+            the post-layout simulation results and the log file.
+        """
+        specs = self.render(design)
+        gen_fut = self.prj.gen_cell(specs, gen_lay=True, gen_sch=True, run_lvs=True,
+                                    run_rcx=True)
+        return self.prj.sim_cell(specs, dep=gen_fut, gen_wrapper=True, gen_tb=True,
+                                 run_sim=True, extract=True)
+
+    def staged_evaluate(self, batch_of_designs: Sequence[Dict[str, Any]],
+                        keep: Optional[Callable[[Dict[str, Any], Any], bool]] = None,
+                        top_k: Optional[int] = None,
+                        score: Optional[Callable[[Dict[str, Any], Any], float]] = None,
+                        sync: bool = False) -> Tuple[List[Any], List[Any]]:
+        """
+        Multi-fidelity evaluation: screens the whole batch with screen_design and submits
+        evaluate_design only for the survivors. Results of the screening stage are consumed
+        as they complete, and each survivor's expensive stage is submitted as soon as it is
+        known to pass, there is no barrier between the two stages.
+
+        Parameters
+        ----------
+        batch_of_designs: Sequence[Dict[str, Any]]
+            the designs to evaluate.
+        keep: Callable[[Dict[str, Any], Any], bool]
+            optional filter called with (design, screening results), False drops the design.
+        top_k: int
+            optional number of designs to keep, ranked by score among designs passing keep.
+            A design is promoted as soon as its rank is certain.
+        score: Callable[[Dict[str, Any], Any], float]
+            called with (design, screening results), higher is better. Required with top_k.
+        sync: bool
+            True to wait for the expensive stage and return its results instead of futures.
+
+        Returns
+        -------
+        screen_results: List[Any]
+            the screening results aligned with batch_of_designs, SystemError for failed jobs.
+        final_results: List[Any]
+            aligned with batch_of_designs, the expensive stage FutureWrapper (or its result
+            if sync is True) for survivors and None for screened-out designs.
+        """
+        from .client_wrapper import iter_completed
+
+        if top_k is not None and score is None:
+            raise ValueError('score is required when top_k is given')
+
+        n_designs = len(batch_of_designs)
+        screen_futs = [self.screen_design(design) for design in batch_of_designs]
+        gate = _TopKGate(top_k, n_designs) if top_k is not None else None
+
+        screen_results: List[Any] = [None] * n_designs
+        final_results: List[Any] = [None] * n_designs
+
+        def _promote(idx: int) -> None:
+            final_results[idx] = self.evaluate_design(batch_of_designs[idx],
+                                                      screen_results[idx])
+
+        for idx, fut in iter_completed(screen_futs):
+            design = batch_of_designs[idx]
+            try:
+                res = fut.result()
+            except SystemError:
+                res = SystemError
+            screen_results[idx] = res
+
+            passed = res is not SystemError and (keep is None or keep(design, res[0]))
+            if gate is None:
+                if passed:
+                    _promote(idx)
+            else:
+                design_score = score(design, res[0]) if passed else None
+                admitted, _ = gate.update(idx, design_score)
+                for admitted_idx in admitted:
+                    _promote(admitted_idx)
+
+        if sync:
+            survivors = [idx for idx, fut in enumerate(final_results) if fut is not None]
+            cleared = self.get_results([final_results[idx] for idx in survivors])
+            for idx, res in zip(survivors, cleared):
+                final_results[idx] = res
+        return screen_results, final_results
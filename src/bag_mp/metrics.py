@@ -0,0 +1,458 @@
+"""Lightweight metrics for bag_mp: counters, gauges and histograms.
+
+Updating a metric is a dictionary update under a lock, cheap enough to leave on in
+production. Values that are expensive to compute (jobs running on the cluster, run times
+of finished jobs, size of the temporary directory) are produced by collectors that only run
+when the metrics are read, and the temporary directory is walked in a background thread
+at most every TMP_DIR_INTERVAL seconds. Metrics can be read from Python through REGISTRY,
+or scraped in Prometheus text format from the HTTP endpoint started by start_http_server.
+"""
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import os
+import math
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LabelValues = Tuple[str, ...]
+
+# seconds, from quick schematic sims to multi-hour post-layout runs
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600,
+                    7200, 14400)
+# seconds between two walks of a watched temporary directory, usually a large NFS directory
+TMP_DIR_INTERVAL = 300
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    items = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    """A monotonically increasing value per label set."""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        _Metric.__init__(self, name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0)
+
+    def label_sets(self) -> List[LabelValues]:
+        with self._lock:
+            return list(self._values)
+
+    def items(self) -> List[Tuple[LabelValues, float]]:
+        with self._lock:
+            return list(self._values.items())
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    """A value per label set that can go up and down."""
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def replace(self, values: Dict[LabelValues, float]) -> None:
+        """Replaces all label sets at once, used by collectors."""
+        with self._lock:
+            self._values = dict(values)
+
+
+class Histogram(_Metric):
+    """Counts observations in cumulative buckets, per label set."""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DURATION_BUCKETS) -> None:
+        _Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (per-bucket counts, sum)
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[idx] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._label_values(labels), ([], 0.0))
+            return sum(counts)
+
+    def quantile(self, q: float, **labels: str) -> Optional[float]:
+        """Estimates the q-quantile by linear interpolation inside buckets, like
+        Prometheus' histogram_quantile. None without observations."""
+        with self._lock:
+            counts, _ = self._values.get(self._label_values(labels), ([], 0.0))
+            counts = list(counts)
+        n = sum(counts)
+        if n == 0:
+            return None
+        rank = q * n
+        cumulative = 0
+        for idx, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                upper = self.buckets[idx]
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                if upper == math.inf:
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-2]
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for upper, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(upper)}"'
+                yield (f'{self.name}_bucket{_format_labels(self.label_names, key, le)} '
+                       f'{cumulative}')
+            labels = _format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    """A set of metrics and of collectors refreshing them on read."""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> _Metric:
+        return self._metrics[name]
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]) -> None:
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def collect(self) -> None:
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception:
+                # a scrape must not fail because e.g. the scheduler is unreachable
+                pass
+
+    def render(self) -> str:
+        """Returns all metrics in Prometheus text exposition format."""
+        self.collect()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+JOBS_SUBMITTED = REGISTRY.register(Counter(
+    'bag_mp_jobs_submitted_total', 'Jobs submitted.', ('stage', 'bag_id')))
+JOBS_FINISHED = REGISTRY.register(Counter(
+    'bag_mp_jobs_finished_total', 'Jobs that left the queue, by final status '
+    '(finished, error, cancelled).', ('stage', 'bag_id', 'status')))
+JOBS_CACHED = REGISTRY.register(Counter(
+    'bag_mp_jobs_cached_total', 'Jobs served from a journal without running.',
+    ('stage', 'bag_id')))
+JOBS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'bag_mp_jobs_in_flight', 'Submitted jobs that have not finished yet.',
+    ('stage', 'bag_id')))
+JOBS_RUNNING = REGISTRY.register(Gauge(
+    'bag_mp_jobs_running', 'Jobs currently processing on a worker, the rest of the '
+    'in-flight jobs are pending. A proxy for simulator license use.', ('stage', 'bag_id')))
+JOB_LATENCY = REGISTRY.register(Histogram(
+    'bag_mp_job_latency_seconds', 'Time from submission to completion of finished jobs, '
+    'queueing included.', ('stage', 'bag_id')))
+JOB_RUN_TIME = REGISTRY.register(Histogram(
+    'bag_mp_job_run_seconds', 'Time finished jobs spent running on a worker, a micro-batch '
+    'counts once.', ('stage', 'bag_id')))
+TMP_DIR_BYTES = REGISTRY.register(Gauge(
+    'bag_mp_tmp_dir_bytes', 'Size of the BAG temporary directory.', ('path',)))
+RESULTS_GATHERED = REGISTRY.register(Counter(
+    'bag_mp_results_gathered_total', 'Futures gathered through get_results.'))
+SYNC_WAIT = REGISTRY.register(Histogram(
+    'bag_mp_synchronize_seconds', 'Time spent blocked in synchronize.'))
+
+
+def dir_size(path: os.PathLike) -> int:
+    """Returns the total size of the files under path."""
+    total = 0
+    stack = [str(path)]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    return total
+
+
+class JobTracker:
+    """Keeps the in-flight jobs by key and feeds the job metrics."""
+
+    def __init__(self, tmp_dir_interval: float = TMP_DIR_INTERVAL) -> None:
+        # key -> [stage, bag_id, number of submissions not released yet]
+        self._jobs: Dict[str, List] = {}
+        self._tmp_dirs = set()
+        self.tmp_dir_interval = tmp_dir_interval
+        # path -> (monotonic time of the last walk, size)
+        self._tmp_sizes: Dict[str, Tuple[float, int]] = {}
+        self._walking = set()
+        # finished tasks whose run time is not known yet: key -> (stage, bag_id, submit time)
+        self._unmeasured: Dict[str, Tuple[str, str, float]] = {}
+        self._lock = threading.Lock()
+
+    def submitted(self, key: str, stage: str, bag_id: str) -> float:
+        """Records a submission, returns its timestamp to pass to released."""
+        JOBS_SUBMITTED.inc(stage=stage, bag_id=bag_id)
+        JOBS_IN_FLIGHT.inc(stage=stage, bag_id=bag_id)
+        with self._lock:
+            entry = self._jobs.setdefault(key, [stage, bag_id, 0])
+            entry[2] += 1
+        return time.monotonic()
+
+    def released(self, key: str, stage: str, bag_id: str, status: str, t0: float,
+                 timed: bool = True) -> None:
+        """Records the end of a submission, status as given by add_release_callback. timed
+        is False for jobs whose task does not run them, like the jobs of a micro-batch."""
+        JOBS_FINISHED.inc(stage=stage, bag_id=bag_id, status=status)
+        JOBS_IN_FLIGHT.dec(stage=stage, bag_id=bag_id)
+        if status == 'finished':
+            latency = time.monotonic() - t0
+            JOB_LATENCY.observe(latency, stage=stage, bag_id=bag_id)
+            if timed:
+                self.task_finished(key, stage, bag_id, time.time() - latency)
+        with self._lock:
+            entry = self._jobs.get(key, None)
+            if entry is not None:
+                entry[2] -= 1
+                if entry[2] <= 0:
+                    del self._jobs[key]
+
+    def task_finished(self, key: str, stage: str, bag_id: str, submitted: float) -> None:
+        """Queues a finished task, submitted at time submitted, for collect_run_times."""
+        with self._lock:
+            self._unmeasured[key] = (stage, bag_id, submitted)
+
+    def collect_run_times(self) -> None:
+        """Observes the run times of the finished tasks from the scheduler's task stream,
+        which has to be recording, see trace.ensure_task_stream."""
+        with self._lock:
+            unmeasured, self._unmeasured = self._unmeasured, {}
+        if not unmeasured:
+            return
+        from dask.distributed import get_client
+        start = min(submitted for _, _, submitted in unmeasured.values()) - 1
+        run_times = {}
+        for entry in get_client().get_task_stream(start=start):
+            if entry['key'] in unmeasured:
+                computes = [ss['stop'] - ss['start'] for ss in entry['startstops']
+                            if ss['action'] == 'compute']
+                if computes:
+                    # the last execution wins for retried tasks
+                    run_times[entry['key']] = computes[-1]
+        for key, run_time in run_times.items():
+            stage, bag_id, _ = unmeasured[key]
+            JOB_RUN_TIME.observe(run_time, stage=stage, bag_id=bag_id)
+
+    def watch_tmp_dir(self, path: Optional[os.PathLike]) -> None:
+        if path is not None:
+            with self._lock:
+                self._tmp_dirs.add(str(path))
+
+    def collect_running(self) -> None:
+        """Counts the tracked jobs processing on a worker, asks the scheduler only when
+        something is in flight."""
+        with self._lock:
+            jobs = {key: (stage, bag_id) for key, (stage, bag_id, _) in self._jobs.items()}
+        running: Dict[LabelValues, float] = {}
+        if jobs:
+            from dask.distributed import get_client
+            for keys in get_client().processing().values():
+                for key in keys:
+                    if key in jobs:
+                        running[jobs[key]] = running.get(jobs[key], 0) + 1
+        JOBS_RUNNING.replace(running)
+
+    def collect_tmp_dirs(self) -> None:
+        """Reports the last known size of the watched directories and starts a background
+        walk of the ones whose size is older than tmp_dir_interval. A directory is only
+        reported once its first walk is done."""
+        now = time.monotonic()
+        with self._lock:
+            stale = [path for path in sorted(self._tmp_dirs) if path not in self._walking and
+                     now - self._tmp_sizes.get(path, (-math.inf, 0))[0] >= self.tmp_dir_interval]
+            self._walking.update(stale)
+            sizes = {(path,): size for path, (_, size) in self._tmp_sizes.items()}
+        for path in stale:
+            threading.Thread(target=self._walk_tmp_dir, args=(path,), name='bag_mp-dir-size',
+                             daemon=True).start()
+        TMP_DIR_BYTES.replace(sizes)
+
+    def _walk_tmp_dir(self, path: str) -> None:
+        try:
+            size = dir_size(path)
+            with self._lock:
+                self._tmp_sizes[path] = (time.monotonic(), size)
+        finally:
+            with self._lock:
+                self._walking.discard(path)
+
+
+JOBS = JobTracker()
+REGISTRY.add_collector(JOBS.collect_running)
+REGISTRY.add_collector(JOBS.collect_run_times)
+REGISTRY.add_collector(JOBS.collect_tmp_dirs)
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    Returns the current metrics as plain Python values.
+
+    Returns
+    -------
+    snapshot: Dict[str, Any]
+        'jobs' maps each (stage, bag_id) to its submitted, in_flight, running and pending
+        job counts, finished/error/cancelled counts, failure_rate (errors over finished
+        plus errors), p50/p99 latency estimates in seconds from submission to completion
+        and run_p50/run_p99 estimates of the time spent running. 'tmp_dir_bytes' maps each
+        watched temporary directory to its size as of its last walk.
+    """
+    REGISTRY.collect()
+    labels = set(JOBS_SUBMITTED.label_sets()) | set(JOBS_CACHED.label_sets())
+    labels |= {key[:2] for key in JOBS_FINISHED.label_sets()}
+    jobs = {}
+    for stage, bag_id in sorted(labels):
+        ids = dict(stage=stage, bag_id=bag_id)
+        finished = {status: JOBS_FINISHED.get(status=status, **ids)
+                    for status in ('finished', 'error', 'cancelled')}
+        in_flight = JOBS_IN_FLIGHT.get(**ids)
+        running = JOBS_RUNNING.get(**ids)
+        done = finished['finished'] + finished['error']
+        jobs[(stage, bag_id)] = dict(
+            submitted=JOBS_SUBMITTED.get(**ids),
+            cached=JOBS_CACHED.get(**ids),
+            in_flight=in_flight,
+            running=running,
+            pending=max(in_flight - running, 0),
+            failure_rate=finished['error'] / done if done else 0.0,
+            p50=JOB_LATENCY.quantile(0.5, **ids),
+            p99=JOB_LATENCY.quantile(0.99, **ids),
+            run_p50=JOB_RUN_TIME.quantile(0.5, **ids),
+            run_p99=JOB_RUN_TIME.quantile(0.99, **ids),
+            **finished,
+        )
+    tmp_dir_bytes = {key[0]: value for key, value in TMP_DIR_BYTES.items()}
+    return dict(jobs=jobs, tmp_dir_bytes=tmp_dir_bytes)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def start_http_server(port: int, addr: str = '127.0.0.1',
+                      registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Serves registry at http://addr:port/metrics from a daemon thread. Port 0 picks a free
+    port, see server.server_address. Call shutdown() on the server to stop it."""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='bag_mp-metrics', daemon=True)
+    thread.start()
+    return server
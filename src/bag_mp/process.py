@@ -0,0 +1,106 @@
+"""Cancellable execution of BAG subprocesses.
+
+The child runs in its own process group and is watched while it runs. When the dask task
+that started it is cancelled or released (e.g. an optimizer dropped the future), or the
+timeout expires, the whole process tree gets SIGTERM and, after a grace period, SIGKILL,
+so the worker slot and any simulator license are freed right away.
+"""
+
+from typing import Callable, Optional, Sequence
+
+import os
+import time
+import signal
+import subprocess
+
+POLL_INTERVAL = 1
+KILL_GRACE_PERIOD = 10
+# worker task states in which nobody is waiting for the result anymore
+CANCELLED_STATES = ('cancelled', 'released', 'forgotten')
+
+
+class ProcessCancelledError(SystemError):
+    """Raised when a subprocess was killed because its dask task was cancelled."""
+
+
+def get_cancel_check() -> Optional[Callable[[], bool]]:
+    """Returns a callable telling whether the dask task running in this thread was
+    cancelled, or None when not running inside a dask task."""
+    try:
+        from distributed import get_worker
+        worker = get_worker()
+        key = worker.get_current_task()
+    except (ImportError, ValueError, AttributeError):
+        return None
+    tasks = getattr(worker, 'state', worker).tasks
+
+    def cancelled() -> bool:
+        ts = tasks.get(key, None)
+        return ts is None or ts.state in CANCELLED_STATES
+
+    return cancelled
+
+
+def kill_process_tree(proc: subprocess.Popen, grace_period: float = KILL_GRACE_PERIOD) -> None:
+    """Sends SIGTERM to the process group of proc, then SIGKILL if it is still alive after
+    grace_period seconds."""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        proc.wait(timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        # also reaps grandchildren that ignored SIGTERM after the leader exited
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def run_cancellable(cmd: Sequence[str], timeout: Optional[float] = None,
+                    poll_interval: float = POLL_INTERVAL,
+                    grace_period: float = KILL_GRACE_PERIOD, **kwargs) -> int:
+    """
+    Runs cmd in a new process group and waits for it, like subprocess.call.
+
+    Parameters
+    ----------
+    cmd: Sequence[str]
+        the command to run.
+    timeout: float
+        optional timeout in seconds, the process tree is killed and
+        subprocess.TimeoutExpired raised when it expires.
+    poll_interval: float
+        seconds between two cancellation checks.
+    grace_period: float
+        seconds between SIGTERM and SIGKILL.
+    kwargs:
+        passed to subprocess.Popen.
+
+    Returns
+    -------
+    exit_code: int
+        the exit code of the process.
+    """
+    cancelled = get_cancel_check()
+    deadline = None if timeout is None else time.time() + timeout
+    proc = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+    try:
+        while True:
+            try:
+                return proc.wait(timeout=poll_interval)
+            except subprocess.TimeoutExpired:
+                pass
+            if cancelled is not None and cancelled():
+                kill_process_tree(proc, grace_period)
+                raise ProcessCancelledError(f'task cancelled, killed {" ".join(cmd)}')
+            if deadline is not None and time.time() > deadline:
+                kill_process_tree(proc, grace_period)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+    finally:
+        if proc.poll() is None:
+            # interrupted while waiting, don't leave an orphaned tree behind
+            kill_process_tree(proc, grace_period)
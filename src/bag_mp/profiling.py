@@ -0,0 +1,115 @@
+"""Opt-in profiling of bag_mp jobs and of the BAG processes they start.
+
+Each profiled job leaves two cProfile dumps in the profile directory:
+
+- <key>.job.prof: the orchestration running on the worker (_gen_cell/_sim_cell/_meas_cell,
+  spec and dump I/O, waiting on the subprocess).
+- <key>.bag.prof: the BAG python child, profiled through the sitecustomize hook in
+  _profile_hook that is put on its PYTHONPATH. This needs run_bag.sh to pass PYTHONPATH
+  and the environment through to python.
+
+Client-side time (to_immutable, task fan-out, ...) can be captured with profile_block
+into client*.prof. merge_profiles aggregates any set of dumps into one pstats report.
+"""
+
+from typing import Dict, Iterable, Optional, Callable, Any
+
+import os
+import io
+import pstats
+import cProfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+PROFILE_ENV = 'BAG_MP_PROFILE_OUT'
+HOOK_DIR = Path(__file__).resolve().parent / '_profile_hook'
+PROFILE_KINDS = {
+    'all': '*.prof',
+    'jobs': '*.job.prof',
+    'bag': '*.bag.prof',
+    'client': 'client*.prof',
+}
+
+_current = threading.local()
+
+
+def run_profiled(prof_path: os.PathLike, func: Callable, *args, **kwargs) -> Any:
+    """Runs func under cProfile and dumps the stats to prof_path, runs on the workers.
+
+    While func runs, BAG processes started from this thread are profiled into the
+    matching .bag.prof file.
+    """
+    prof_path = Path(prof_path)
+    prof_path.parent.mkdir(parents=True, exist_ok=True)
+    _current.bag_prof_path = prof_path.with_name(prof_path.name.replace('.job.prof',
+                                                                        '.bag.prof'))
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        _current.bag_prof_path = None
+        profiler.dump_stats(prof_path)
+
+
+def get_child_env() -> Dict[str, str]:
+    """Returns the environment variables that make a BAG child profile itself, empty when
+    the current thread is not running a profiled job."""
+    bag_prof_path = getattr(_current, 'bag_prof_path', None)
+    if bag_prof_path is None:
+        return {}
+    python_path = os.environ.get('PYTHONPATH', '')
+    python_path = f'{HOOK_DIR}{os.pathsep}{python_path}' if python_path else str(HOOK_DIR)
+    return {
+        PROFILE_ENV: str(bag_prof_path),
+        'PYTHONPATH': python_path,
+    }
+
+
+@contextmanager
+def profile_block(prof_path: os.PathLike):
+    """Profiles the enclosed block, e.g. client-side submission code, into prof_path."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        Path(prof_path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(prof_path)
+
+
+def merge_profiles(paths: Iterable[os.PathLike]) -> Optional[pstats.Stats]:
+    """Merges cProfile dumps into one pstats.Stats, None if there is nothing to merge."""
+    stats = None
+    for path in paths:
+        try:
+            if stats is None:
+                stats = pstats.Stats(str(path), stream=io.StringIO())
+            else:
+                stats.add(str(path))
+        except (OSError, EOFError, TypeError, ValueError):
+            # a job that was killed before it could write a complete dump
+            continue
+    return stats
+
+
+def collect_profiles(profile_dir: os.PathLike, kind: str = 'all') -> Optional[pstats.Stats]:
+    """Merges the dumps of one kind ('all', 'jobs', 'bag' or 'client') in profile_dir."""
+    try:
+        pattern = PROFILE_KINDS[kind]
+    except KeyError:
+        raise ValueError(f'unknown profile kind {kind!r}, '
+                         f'expected one of {list(PROFILE_KINDS)}') from None
+    return merge_profiles(sorted(Path(profile_dir).glob(pattern)))
+
+
+def format_report(stats: Optional[pstats.Stats], sort: str = 'cumulative',
+                  limit: int = 30) -> str:
+    """Returns the pstats text report of stats."""
+    if stats is None:
+        return 'no profiles collected\n'
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
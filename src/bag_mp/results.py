@@ -0,0 +1,215 @@
+"""Worker-side projection of job results and lazy handles for large results.
+
+sim_cell/meas_cell results can carry full waveforms while callers usually need a few
+scalars. Projecting on the worker means only the selected values travel to the client.
+Results whose dump exceeds the spill threshold are not loaded at all: the dump is moved
+to a file named after the job in a spill directory shared by the workers, by default
+$BAG_TEMP_DIR/spill, and the job returns a LazyResult pointing at it, which loads it on
+demand. Projections read through it. BagMP deletes the file once the job's future is
+released, so a LazyResult must not outlive its future.
+"""
+
+from typing import Any, Callable, Optional, Sequence, Tuple, Union
+
+import os
+import glob
+import uuid
+import shutil
+import socket
+import tempfile
+from pathlib import Path
+
+from .file import io_cls_dict
+
+# dumps larger than this many bytes are returned as LazyResult unless projected
+SPILL_THRESHOLD = 64 * 1024 ** 2
+# spilled dumps are moved here, under BAG_TEMP_DIR
+SPILL_DIRNAME = 'spill'
+
+Field = Union[str, int, Tuple[Union[str, int], ...]]
+Fields = Union[Sequence[Field], Callable[[Any], Any]]
+
+
+def _get_field(result: Any, field: Field) -> Any:
+    if isinstance(field, tuple):
+        for item in field:
+            result = result[item]
+        return result
+    return result[field]
+
+
+def project(result: Any, fields: Optional[Fields]) -> Any:
+    """
+    Selects or reduces part of a result.
+
+    Parameters
+    ----------
+    result: Any
+        the loaded result.
+    fields: Fields
+        None to keep the whole result, a callable applied to the result, or a sequence of
+        fields. A field is a key, or a tuple of keys addressing a nested value.
+
+    Returns
+    -------
+    projected: Any
+        the callable's return value, or a dictionary from each field to its value.
+    """
+    if fields is None:
+        return result
+    if callable(fields):
+        return fields(result)
+    return {field: _get_field(result, field) for field in fields}
+
+
+def _load(path: os.PathLike, io_format: str) -> Any:
+    return io_cls_dict[io_format].load(path)
+
+
+class LazyResult:
+    """
+    A handle to a result left on disk by a worker.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        the dump file.
+    io_format: str
+        yaml or pickle.
+    worker: Optional[str]
+        address of the worker that wrote path, None if it was not produced inside a worker.
+    nbytes: int
+        size of the dump file.
+    """
+
+    def __init__(self, path: os.PathLike, io_format: str, worker: Optional[str] = None,
+                 nbytes: int = 0) -> None:
+        self.path = Path(path)
+        self.io_format = io_format
+        self.worker = worker
+        self.host = socket.gethostname()
+        self.nbytes = nbytes
+
+    def __repr__(self) -> str:
+        return (f'LazyResult({str(self.path)!r}, io_format={self.io_format!r}, '
+                f'worker={self.worker!r}, nbytes={self.nbytes})')
+
+    def to_future(self, fields: Optional[Fields] = None):
+        """Loads, and optionally projects, the result on a worker. Raises FileNotFoundError
+        if the file is gone and no live worker could still read it."""
+        from dask.distributed import get_client
+        from .client_wrapper import FutureWrapper
+
+        client = get_client()
+        workers = None
+        if not self.path.exists():
+            # unless its directory is not visible from here, the worker that wrote it may
+            # still read it
+            if (self.path.parent.exists() or self.worker is None
+                    or self.worker not in client.scheduler_info()['workers']):
+                raise FileNotFoundError(f'spilled result {self.path} is gone, its job was '
+                                        f'released or worker {self.worker} died')
+            workers = [self.worker]
+        fut = client.submit(_load_and_project, self.path, self.io_format, fields,
+                            workers=workers, allow_other_workers=False, pure=False)
+        return FutureWrapper.from_future(fut)
+
+    def result(self, fields: Optional[Fields] = None) -> Any:
+        """Fetches the result, reading it directly when the file is reachable from here."""
+        if self.host == socket.gethostname() and self.path.exists():
+            return project(_load(self.path, self.io_format), fields)
+        return self.to_future(fields).result()
+
+
+def project_output(output: Tuple[Any, Any], fields: Optional[Fields]) -> Tuple[Any, Any]:
+    """Applies fields to the (result, log file) output of a sim_cell/meas_cell job, reading
+    a LazyResult from its dump. Runs on the workers."""
+    result, log_file = output
+    if isinstance(result, LazyResult):
+        return result.result(fields), log_file
+    return project(result, fields), log_file
+
+
+def is_spilled(output: Any) -> bool:
+    """Whether output is the (LazyResult, log file) output of a sim_cell/meas_cell job."""
+    return isinstance(output, tuple) and len(output) == 2 and isinstance(output[0], LazyResult)
+
+
+def remove_spilled(spill_dir: os.PathLike, key: str) -> None:
+    """Deletes the spilled dump of job key, if any."""
+    for path in glob.glob(os.path.join(glob.escape(str(spill_dir)), f'{glob.escape(key)}.*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _load_and_project(path: os.PathLike, io_format: str, fields: Optional[Fields]) -> Any:
+    return project(_load(path, io_format), fields)
+
+
+def load_output(path: os.PathLike, io_format: str, fields: Optional[Fields] = None,
+                spill_threshold: Optional[int] = SPILL_THRESHOLD, key: Optional[str] = None,
+                spill_dir: Optional[os.PathLike] = None, **kwargs) -> Any:
+    """
+    Loads a job's output dump on the worker, projecting it or spilling it.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        the dump file written by the bag script.
+    io_format: str
+        yaml or pickle.
+    fields: Fields
+        optional projection, see project.
+    spill_threshold: Optional[int]
+        unprojected dumps larger than this many bytes are moved to spill_dir and returned
+        as a LazyResult. None to always load.
+    key: Optional[str]
+        the job key naming the spilled dump, defaults to the key of the running task.
+    spill_dir: Optional[os.PathLike]
+        where dumps are spilled, should be shared by the workers. Defaults to a directory
+        in the system temporary directory.
+    kwargs:
+        passed to the io class.
+
+    Returns
+    -------
+    result: Any
+        the (projected) result, or a LazyResult.
+    """
+    if fields is None and spill_threshold is not None:
+        nbytes = os.path.getsize(path)
+        if nbytes > spill_threshold:
+            # path is reused by the next job on the same specs, the spill file is the job's own
+            spill_path = _spill_path(key, io_format, spill_dir)
+            shutil.move(path, spill_path)
+            return LazyResult(spill_path, io_format, worker=_get_worker_address(),
+                              nbytes=nbytes)
+    return project(io_cls_dict[io_format].load(path, **kwargs), fields)
+
+
+def _get_worker():
+    try:
+        from distributed import get_worker
+        return get_worker()
+    except (ImportError, ValueError):
+        return None
+
+
+def _get_worker_address() -> Optional[str]:
+    worker = _get_worker()
+    return None if worker is None else worker.address
+
+
+def _spill_path(key: Optional[str], io_format: str, spill_dir: Optional[os.PathLike]) -> Path:
+    if spill_dir is None:
+        spill_dir = Path(tempfile.gettempdir()) / SPILL_DIRNAME
+    spill_dir = Path(spill_dir)
+    worker = _get_worker()
+    if key is None and worker is not None:
+        key = worker.get_current_task()
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    if key is None:
+        key = uuid.uuid4().hex
+    return spill_dir / f'{key}.{io_format}'
@@ -0,0 +1,95 @@
+"""Job priorities and per-owner fair share for BagMP submissions.
+
+Jobs belong to a priority class and an owner (a user or a FlowManager). The class sets a
+dask priority band, classes never interleave. Inside a band the n-th job of every owner
+gets the same priority, so the scheduler serves owners round-robin instead of draining
+the oldest backlog first. On top of that the client-side AdmissionController caps the
+number of batch jobs an owner has in flight, keeping worker slots free for interactive
+jobs on a loaded cluster.
+"""
+
+from typing import Dict, Optional, Tuple
+
+import getpass
+import threading
+from collections import defaultdict
+
+PRIORITY_CLASSES: Dict[str, int] = {
+    'interactive': 2,
+    'normal': 1,
+    'batch': 0,
+}
+# room for this many jobs per owner inside a priority band
+CLASS_STRIDE = 10 ** 9
+# classes that are not subject to admission control
+UNTHROTTLED_CLASSES = ('interactive',)
+
+
+def default_owner() -> str:
+    return getpass.getuser()
+
+
+class AdmissionController:
+    """
+    Computes dask priorities and throttles submissions per owner.
+
+    Parameters
+    ----------
+    max_in_flight: Optional[int]
+        maximum number of unfinished jobs per owner in throttled classes, None for no limit.
+        Set it below the number of worker threads to reserve capacity for interactive jobs.
+    """
+
+    def __init__(self, max_in_flight: Optional[int] = None) -> None:
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        self._submitted: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._in_flight: Dict[str, int] = defaultdict(int)
+
+    @staticmethod
+    def _check_class(priority_class: str) -> None:
+        if priority_class not in PRIORITY_CLASSES:
+            raise ValueError(f'unknown priority class {priority_class!r}, '
+                             f'expected one of {list(PRIORITY_CLASSES)}')
+
+    @staticmethod
+    def _dask_priority(priority_class: str, n_submitted: int) -> int:
+        return PRIORITY_CLASSES[priority_class] * CLASS_STRIDE - min(n_submitted,
+                                                                     CLASS_STRIDE - 1)
+
+    def priority(self, owner: str, priority_class: str) -> int:
+        """Returns the dask priority of the next job of owner in priority_class."""
+        self._check_class(priority_class)
+        with self._cond:
+            n_submitted = self._submitted[owner, priority_class]
+            self._submitted[owner, priority_class] += 1
+        return self._dask_priority(priority_class, n_submitted)
+
+    def last_priority(self, owner: str, priority_class: str) -> int:
+        """Returns the dask priority of the last job of owner in priority_class without
+        counting a new job, for helper tasks of that job like projections."""
+        self._check_class(priority_class)
+        with self._cond:
+            n_submitted = self._submitted.get((owner, priority_class), 0)
+        return self._dask_priority(priority_class, max(n_submitted - 1, 0))
+
+    def acquire(self, owner: str, priority_class: str, timeout: Optional[float] = None) -> None:
+        """Blocks until owner may put another job of priority_class in flight."""
+        self._check_class(priority_class)
+        with self._cond:
+            if self.max_in_flight is not None and priority_class not in UNTHROTTLED_CLASSES:
+                admitted = self._cond.wait_for(
+                    lambda: self._in_flight[owner] < self.max_in_flight, timeout)
+                if not admitted:
+                    raise TimeoutError(f'{owner} has {self._in_flight[owner]} jobs in flight')
+            self._in_flight[owner] += 1
+
+    def release(self, owner: str) -> None:
+        """Marks one job of owner as finished."""
+        with self._cond:
+            self._in_flight[owner] -= 1
+            self._cond.notify_all()
+
+    def in_flight(self) -> Dict[str, int]:
+        with self._cond:
+            return dict(self._in_flight)
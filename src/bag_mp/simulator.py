@@ -0,0 +1,430 @@
+"""Offline discrete-event simulation of BagMP workloads for capacity planning.
+
+Jobs recorded in a trace (see trace) are replayed against a hypothetical cluster: a number
+of workers and threads, license pools modelled as dask resources, and a scheduling policy
+(priority classes and fair share, micro-batching, locality). No cluster is needed. The
+simulation predicts the makespan, worker and license utilization and queueing delays, e.g.
+
+    jobs = replicate(jobs_from_trace(load_trace('trace.jsonl')), 10)
+    for n_workers in (8, 16, 32):
+        print(simulate(jobs, n_workers, licenses={'spectre': 8}).summary())
+
+or from the command line, python -m bag_mp.simulator trace.jsonl -w 8 16 32 -l spectre=8.
+The model is deliberately simple: a job takes its recorded run time on any worker, a
+micro-batch pays the BAG startup time once, and a job running away from the worker of one
+of its dependencies pays a fixed transfer time.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import heapq
+import argparse
+from collections import Counter, defaultdict
+
+from .scheduling import PRIORITY_CLASSES
+
+
+class SimJob:
+    """
+    A job to simulate.
+
+    Parameters
+    ----------
+    key: str
+        unique name of the job.
+    stage: str
+        gen_cell, sim_cell, meas_cell or a split gen_cell stage.
+    duration: float
+        run time in seconds, including the BAG startup time.
+    submit: float
+        submission time in seconds, relative to the start of the workload.
+    deps: Sequence[str]
+        keys of the jobs that have to finish first, unknown keys are ignored.
+    priority: str
+        priority class.
+    owner: str
+        fair-share owner.
+    bag_id: str
+        BAG2 or BAG3, jobs are only batched with jobs of the same stage and bag_id.
+    resources: Dict[str, float]
+        the dask resources, i.e. licenses, held while the job runs.
+    """
+
+    def __init__(self, key: str, stage: str, duration: float, submit: float = 0.0,
+                 deps: Sequence[str] = (), priority: str = 'normal', owner: str = '',
+                 bag_id: str = '', resources: Optional[Dict[str, float]] = None) -> None:
+        self.key = key
+        self.stage = stage
+        self.duration = duration
+        self.submit = submit
+        self.deps = list(deps)
+        self.priority = priority
+        self.owner = owner
+        self.bag_id = bag_id
+        self.resources = {} if resources is None else dict(resources)
+
+    def __repr__(self) -> str:
+        return (f'SimJob({self.key!r}, {self.stage!r}, duration={self.duration:.4g}, '
+                f'submit={self.submit:.4g}, deps={len(self.deps)})')
+
+
+def jobs_from_trace(records: Iterable[Dict[str, Any]]) -> List[SimJob]:
+    """Builds SimJobs from trace records, skipping jobs that never ran. Job keys are
+    deterministic, so a trace appended to by several runs can hold a key more than once:
+    only its last execution is kept. The runs, told apart by their session, are laid out
+    back to back, each one starting when the previous one ended. Micro-batches are replayed
+    as their batch task, which the dependents of its jobs wait for."""
+    executed = {}
+    for record in records:
+        if record.get('start', None) is not None:
+            executed[record['key']] = record
+    # the last execution of a key may not have been in a batch
+    batch_of = {member: record['key'] for record in executed.values()
+                for member in record.get('members', [])
+                if executed.get(member, {}).get('batched', False)}
+    members = defaultdict(list)
+    for record in executed.values():
+        if record['key'] in batch_of:
+            members[batch_of[record['key']]].append(record)
+    records = [record for record in executed.values() if record['key'] not in batch_of]
+    if not records:
+        return []
+
+    sessions = defaultdict(list)
+    for record in records:
+        sessions[record.get('session', '')].append(record)
+    submit, offset = {}, 0.0
+    for session in sorted(sessions.values(), key=lambda rs: min(r['submit'] for r in rs)):
+        t0 = min(record['submit'] for record in session)
+        for record in session:
+            submit[record['key']] = record['submit'] - t0 + offset
+        offset += max(record['end'] for record in session) - t0
+
+    jobs = []
+    for record in records:
+        # a batch task takes the scheduling attributes of the jobs it ran
+        info = members[record['key']][0] if members[record['key']] else record
+        deps = [batch_of.get(dep, dep) for dep in record.get('deps', [])]
+        jobs.append(SimJob(record['key'], record['stage'], record['end'] - record['start'],
+                           submit=submit[record['key']], deps=deps,
+                           priority=info.get('priority', 'normal'), owner=info.get('owner', ''),
+                           bag_id=record.get('bag_id', ''),
+                           resources=info.get('resources', None)))
+    return jobs
+
+
+def replicate(jobs: Sequence[SimJob], n: int, spacing: float = 0.0) -> List[SimJob]:
+    """Plans a sweep of n copies of jobs, e.g. the trace of one design, the i-th copy
+    being submitted i * spacing seconds later."""
+    planned = []
+    for i in range(n):
+        keys = {job.key: f'{job.key}#{i}' for job in jobs}
+        for job in jobs:
+            planned.append(SimJob(keys[job.key], job.stage, job.duration,
+                                  submit=job.submit + i * spacing,
+                                  deps=[keys.get(dep, dep) for dep in job.deps],
+                                  priority=job.priority, owner=job.owner, bag_id=job.bag_id,
+                                  resources=job.resources))
+    return planned
+
+
+class Policy:
+    """
+    A scheduling policy.
+
+    Parameters
+    ----------
+    priorities: bool
+        True to order ready jobs by priority class, then round-robin over owners, like
+        scheduling.AdmissionController. False for first come, first served.
+    batch_size: Optional[int]
+        micro-batch up to this many ready jobs without dependencies of the same stage and
+        bag_id, like BagMP(batch_size=...).
+    batch_stages: Optional[Sequence[str]]
+        the stages that may be batched, None for all.
+    startup_time: float
+        seconds of each recorded duration spent starting BAG, paid once per micro-batch.
+    locality: bool
+        True to run jobs on the worker that ran their dependencies when it is free.
+    transfer_time: float
+        seconds added to a job that does not run where all its dependencies ran.
+    replay_submit: bool
+        True to respect the recorded submission times, False to submit everything at 0.
+    """
+
+    def __init__(self, priorities: bool = True, batch_size: Optional[int] = None,
+                 batch_stages: Optional[Sequence[str]] = None, startup_time: float = 0.0,
+                 locality: bool = True, transfer_time: float = 0.0,
+                 replay_submit: bool = True) -> None:
+        self.priorities = priorities
+        self.batch_size = batch_size
+        self.batch_stages = batch_stages
+        self.startup_time = startup_time
+        self.locality = locality
+        self.transfer_time = transfer_time
+        self.replay_submit = replay_submit
+
+
+class SimResult:
+    """The outcome of a simulation, times in seconds."""
+
+    def __init__(self, n_workers: int, threads_per_worker: int,
+                 licenses: Dict[str, float], schedule: Dict[str, Tuple[float, float, float, int]],
+                 busy_time: float, license_time: Dict[str, float], n_processes: int) -> None:
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.licenses = licenses
+        # key -> (ready, start, end, worker)
+        self.schedule = schedule
+        self.n_processes = n_processes
+        if schedule:
+            t0 = min(ready for ready, _, _, _ in schedule.values())
+            self.makespan = max(end for _, _, end, _ in schedule.values()) - t0
+        else:
+            self.makespan = 0.0
+        capacity = n_workers * threads_per_worker * self.makespan
+        self.utilization = busy_time / capacity if capacity else 0.0
+        self.license_utilization = {
+            name: license_time.get(name, 0.0) / (limit * self.makespan) if self.makespan else 0.0
+            for name, limit in licenses.items()
+        }
+        waits = [start - ready for ready, start, _, _ in schedule.values()]
+        self.mean_wait = sum(waits) / len(waits) if waits else 0.0
+        self.max_wait = max(waits) if waits else 0.0
+
+    def summary(self) -> str:
+        lines = [f'workers: {self.n_workers} x {self.threads_per_worker} threads',
+                 f'jobs: {len(self.schedule)} in {self.n_processes} BAG processes',
+                 f'makespan: {self.makespan:.1f} s',
+                 f'worker utilization: {self.utilization:.1%}',
+                 f'queue wait: mean {self.mean_wait:.1f} s, max {self.max_wait:.1f} s']
+        for name, util in sorted(self.license_utilization.items()):
+            lines.append(f'license {name} ({self.licenses[name]:g}): {util:.1%}')
+        return '\n'.join(lines)
+
+
+def simulate(jobs: Sequence[SimJob], n_workers: int, threads_per_worker: int = 1,
+             licenses: Optional[Dict[str, float]] = None,
+             stage_resources: Optional[Dict[str, Dict[str, float]]] = None,
+             policy: Optional[Policy] = None) -> SimResult:
+    """
+    Simulates running jobs on a cluster.
+
+    Parameters
+    ----------
+    jobs: Sequence[SimJob]
+        the workload.
+    n_workers: int
+        number of workers.
+    threads_per_worker: int
+        number of jobs a worker runs at a time.
+    licenses: Dict[str, float]
+        size of each license pool, resources not listed here are unlimited.
+    stage_resources: Dict[str, Dict[str, float]]
+        overrides the resources of the jobs of a stage, e.g. to try a license requirement
+        that was not in place when the trace was recorded.
+    policy: Policy
+        the scheduling policy, Policy() by default.
+
+    Returns
+    -------
+    result: SimResult
+        makespan, utilizations and the schedule of every job.
+    """
+    policy = Policy() if policy is None else policy
+    licenses = dict(licenses or {})
+    stage_resources = stage_resources or {}
+    by_key = {job.key: job for job in jobs}
+    if len(by_key) != len(jobs):
+        raise ValueError('job keys are not unique')
+
+    needs, deps = {}, {}
+    children = defaultdict(list)
+    for job in jobs:
+        resources = stage_resources.get(job.stage, job.resources)
+        needs[job.key] = {name: amount for name, amount in resources.items()
+                          if name in licenses}
+        for name, amount in needs[job.key].items():
+            if amount > licenses[name]:
+                raise ValueError(f'{job.key} needs {amount:g} {name}, the pool has '
+                                 f'{licenses[name]:g}')
+        deps[job.key] = [dep for dep in job.deps if dep in by_key and dep != job.key]
+        for dep in deps[job.key]:
+            children[dep].append(job.key)
+
+    # ranks follow scheduling: class band first, then the n-th job of each owner
+    order = sorted(jobs, key=lambda job: job.submit)
+    nth = Counter()
+    rank = {}
+    for seq, job in enumerate(order):
+        arrival = job.submit if policy.replay_submit else 0.0
+        if policy.priorities:
+            nth[(job.owner, job.priority)] += 1
+            band = PRIORITY_CLASSES.get(job.priority, PRIORITY_CLASSES['normal'])
+            rank[job.key] = (-band, nth[(job.owner, job.priority)], arrival, seq)
+        else:
+            rank[job.key] = (arrival, seq)
+
+    def _batchable(job: SimJob) -> bool:
+        return (policy.batch_size is not None and policy.batch_size > 1 and not deps[job.key]
+                and (policy.batch_stages is None or job.stage in policy.batch_stages))
+
+    events = []
+    for seq, job in enumerate(order):
+        arrival = job.submit if policy.replay_submit else 0.0
+        # at equal times completions (0) are handled before arrivals (1)
+        heapq.heappush(events, (arrival, 1, seq, (job.key,)))
+    n_deps = {key: len(keys) for key, keys in deps.items()}
+    arrived, started = set(), set()
+    ready_time = {}
+    ready = []
+    group_ready = defaultdict(list)
+    free = [threads_per_worker] * n_workers
+    free_licenses = dict(licenses)
+    done_worker = {}
+    schedule = {}
+    busy_time = 0.0
+    license_time = defaultdict(float)
+    n_processes = 0
+    event_seq = len(order)
+
+    def _make_ready(key: str, t: float) -> None:
+        ready_time[key] = t
+        entry = (rank[key], key)
+        heapq.heappush(ready, entry)
+        job = by_key[key]
+        if _batchable(job):
+            heapq.heappush(group_ready[(job.stage, job.bag_id)], entry)
+
+    def _fits(need: Dict[str, float]) -> bool:
+        return all(free_licenses[name] >= amount for name, amount in need.items())
+
+    def _pick_worker(members: List[SimJob]) -> int:
+        if policy.locality:
+            dep_workers = Counter(done_worker[dep] for job in members for dep in deps[job.key])
+            for worker, _ in dep_workers.most_common():
+                if free[worker] > 0:
+                    return worker
+        return max(range(n_workers), key=lambda w: (free[w], -w))
+
+    def _dispatch(t: float) -> None:
+        nonlocal busy_time, n_processes, event_seq
+        skipped = []
+        while ready and any(free):
+            entry = heapq.heappop(ready)
+            key = entry[1]
+            if key in started:
+                continue
+            job = by_key[key]
+            need = needs[key]
+            if not _fits(need):
+                # license bound, lower ranked jobs may go first
+                skipped.append(entry)
+                continue
+            members = [job]
+            if _batchable(job):
+                group = group_ready[(job.stage, job.bag_id)]
+                while group and len(members) < policy.batch_size:
+                    other = heapq.heappop(group)[1]
+                    if other not in started and other != key:
+                        members.append(by_key[other])
+            worker = _pick_worker(members)
+            if len(members) == 1:
+                duration = job.duration
+            else:
+                duration = policy.startup_time + sum(max(m.duration - policy.startup_time, 0.0)
+                                                     for m in members)
+            if policy.transfer_time and any(done_worker[dep] != worker
+                                            for m in members for dep in deps[m.key]):
+                duration += policy.transfer_time
+            end = t + duration
+            free[worker] -= 1
+            for name, amount in need.items():
+                free_licenses[name] -= amount
+                license_time[name] += amount * duration
+            busy_time += duration
+            n_processes += 1
+            for m in members:
+                started.add(m.key)
+                schedule[m.key] = (ready_time[m.key], t, end, worker)
+            event_seq += 1
+            heapq.heappush(events, (end, 0, event_seq,
+                                    (worker, need, [m.key for m in members])))
+        for entry in skipped:
+            heapq.heappush(ready, entry)
+
+    while events:
+        t = events[0][0]
+        while events and events[0][0] == t:
+            _, kind, _, payload = heapq.heappop(events)
+            if kind == 1:
+                key = payload[0]
+                arrived.add(key)
+                if n_deps[key] == 0:
+                    _make_ready(key, t)
+                continue
+            worker, need, keys = payload
+            free[worker] += 1
+            for name, amount in need.items():
+                free_licenses[name] += amount
+            for key in keys:
+                done_worker[key] = worker
+                for child in children[key]:
+                    n_deps[child] -= 1
+                    if n_deps[child] == 0 and child in arrived:
+                        _make_ready(child, t)
+        _dispatch(t)
+
+    if len(schedule) != len(by_key):
+        stuck = sorted(set(by_key) - set(schedule))
+        raise ValueError(f'{len(stuck)} jobs never ran (dependency cycle?), e.g. {stuck[:5]}')
+    return SimResult(n_workers, threads_per_worker, licenses, schedule, busy_time,
+                     dict(license_time), n_processes)
+
+
+def _parse_licenses(items: Sequence[str]) -> Dict[str, float]:
+    licenses = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        licenses[name] = float(value)
+    return licenses
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    from .trace import load_trace
+
+    parser = argparse.ArgumentParser(description='replays a bag_mp trace on hypothetical '
+                                                 'clusters')
+    parser.add_argument('trace', help='trace file recorded with BagMP(trace=...)')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1],
+                        help='worker counts to try')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='threads per worker')
+    parser.add_argument('-l', '--license', nargs='*', default=[],
+                        help='license pools as name=count')
+    parser.add_argument('-n', '--replicate', type=int, default=1,
+                        help='plan a sweep of this many copies of the trace')
+    parser.add_argument('--spacing', type=float, default=0.0,
+                        help='seconds between the submissions of two copies')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--startup', type=float, default=0.0,
+                        help='BAG startup time included in each job duration')
+    parser.add_argument('--transfer', type=float, default=0.0,
+                        help='penalty of running away from a dependency')
+    parser.add_argument('--fifo', action='store_true', help='ignore priorities')
+    parser.add_argument('--no-locality', action='store_true')
+    parser.add_argument('--all-at-once', action='store_true',
+                        help='submit every job at time 0')
+    args = parser.parse_args(argv)
+
+    jobs = replicate(jobs_from_trace(load_trace(args.trace)), args.replicate, args.spacing)
+    policy = Policy(priorities=not args.fifo, batch_size=args.batch_size,
+                    startup_time=args.startup, locality=not args.no_locality,
+                    transfer_time=args.transfer, replay_submit=not args.all_at_once)
+    licenses = _parse_licenses(args.license)
+    for n_workers in args.workers:
+        print(simulate(jobs, n_workers, args.threads, licenses, policy=policy).summary())
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Compact traces of BagMP jobs for capacity planning.
+
+A trace is a JSON-lines file with one record per job: its stage, bag_id, boolean flags,
+priority class, owner, requested dask resources, the keys of the jobs it depends on, the
+client-side submit time, and the start/end time, worker and thread of its last execution.
+Start, end and worker come from the scheduler's task stream, which is collected when the
+trace is flushed. Times are seconds since the epoch. Every record carries the session id of
+the TraceRecorder that wrote it, so traces appended to by several runs can be told apart.
+The simulator module replays traces offline.
+
+Micro-batched jobs are recorded with batched=True, their task only waits for the batch
+task, which gets a record of its own listing the keys of the jobs it ran as 'members'.
+
+Records with an 'alias' entry instead of a 'key' map the key of a join task, like the one
+of a split gen_cell, to the jobs it stands for.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional
+
+import os
+import json
+import time
+import uuid
+import threading
+from pathlib import Path
+
+# released records are written out once this many are waiting for their task stream data
+FLUSH_EVERY = 100
+
+
+def future_keys(obj: Any) -> List[str]:
+    """Returns the keys of the futures in obj, a future or a nested list/tuple/dict of them."""
+    from distributed import Future
+
+    if isinstance(obj, Future):
+        return [obj.key]
+    if isinstance(obj, (list, tuple, set)):
+        return [key for item in obj for key in future_keys(item)]
+    if isinstance(obj, dict):
+        return future_keys(list(obj.values()))
+    return []
+
+
+def _compact_flags(flags: Dict[str, Any]) -> Dict[str, Any]:
+    # only keep what describes the kind of work, not paths or projections
+    return {k: v for k, v in flags.items() if isinstance(v, (bool, int, float, str))}
+
+
+class TraceRecorder:
+    """
+    Records the jobs submitted through a BagMP into a trace file.
+
+    Parameters
+    ----------
+    path: os.PathLike
+        the trace file, appended to if it exists.
+    flush_every: int
+        number of released jobs after which the trace is flushed automatically.
+    """
+
+    def __init__(self, path: os.PathLike, flush_every: int = FLUSH_EVERY) -> None:
+        self.path = Path(path).resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_every = flush_every
+        self.session = uuid.uuid4().hex
+        self._open: Dict[str, Dict[str, Any]] = {}
+        self._released: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def submitted(self, key: str, stage: str, flags: Dict[str, Any], dep: Any = None,
+                  **info: Any) -> None:
+        """Opens the record of a job, info holds e.g. bag_id, priority, owner, resources."""
+        record = dict(key=key, stage=stage, flags=_compact_flags(flags),
+                      deps=future_keys(dep), submit=time.time(), session=self.session,
+                      **info)
+        with self._lock:
+            self._open.setdefault(key, record)
+
+    def alias(self, key: str, deps: List[str]) -> None:
+        """Records that waiting on key means waiting on the jobs deps."""
+        self._write([dict(alias=key, deps=deps)])
+
+    def released(self, key: str, status: str) -> None:
+        """Closes the record of a job, status as given by add_release_callback."""
+        with self._lock:
+            record = self._open.pop(key, None)
+            if record is None:
+                return
+            record['status'] = status
+            record['released'] = time.time()
+            self._released.append(record)
+            flush = len(self._released) >= self.flush_every
+        if flush:
+            try:
+                self.flush()
+            except Exception:
+                # runs in a release callback, retried on the next flush
+                pass
+
+    def flush(self) -> int:
+        """Fills the released records from the task stream and appends them to the trace.
+        Returns the number of records written."""
+        from dask.distributed import get_client
+
+        with self._flush_lock:
+            with self._lock:
+                records, self._released = self._released, []
+            if not records:
+                return 0
+            try:
+                start = min(record['submit'] for record in records) - 1
+                stream = get_client().get_task_stream(start=start)
+            except BaseException:
+                with self._lock:
+                    self._released = records + self._released
+                raise
+            executions = {}
+            for entry in stream:
+                computes = [ss for ss in entry['startstops'] if ss['action'] == 'compute']
+                if computes:
+                    # the last execution wins for retried tasks
+                    executions[entry['key']] = (entry, computes[-1])
+            for record in records:
+                execution = executions.get(record['key'], None)
+                if execution is None:
+                    record.update(start=None, end=None, worker=None)
+                    continue
+                entry, compute = execution
+                if record['status'] == 'cancelled':
+                    # released by this client but kept running for dependent jobs
+                    record['status'] = 'finished' if entry.get('status') == 'OK' else 'error'
+                record.update(start=compute['start'], end=compute['stop'],
+                              worker=entry.get('worker', None), thread=entry.get('thread', None),
+                              nbytes=entry.get('nbytes', None))
+            self._write(records)
+            return len(records)
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+
+def read_trace(path: os.PathLike) -> Iterator[Dict[str, Any]]:
+    """Yields the records of a trace file, skipping a torn last line."""
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def ensure_task_stream(client=None) -> None:
+    """Makes the scheduler start recording its task stream, the trace takes start and end
+    times from it."""
+    if client is None:
+        from dask.distributed import get_client
+        client = get_client()
+    client.get_task_stream(count=0)
+
+
+def load_trace(path: os.PathLike, stages: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Returns the job records of a trace with the aliases resolved into their deps,
+    optionally only the ones of some stages."""
+    records, aliases = [], {}
+    for record in read_trace(path):
+        if 'alias' in record:
+            aliases[record['alias']] = record['deps']
+        else:
+            records.append(record)
+
+    def _resolve(keys: List[str], seen=()) -> List[str]:
+        resolved = []
+        for key in keys:
+            if key in aliases and key not in seen:
+                resolved.extend(_resolve(aliases[key], seen + (key,)))
+            else:
+                resolved.append(key)
+        return resolved
+
+    for record in records:
+        record['deps'] = _resolve(record.get('deps', []))
+    if stages is not None:
+        records = [record for record in records if record['stage'] in stages]
+    return records
@@ -0,0 +1,53 @@
+import sys
+import time
+import subprocess
+import tempfile
+from pathlib import Path
+
+IMPORT_STMT = 'import bag_mp.src.bag_mp'
+NREPEAT = 5
+
+
+def _noop(x):
+    return x
+
+
+def import_time(stmt: str) -> float:
+    # fresh interpreter each time so nothing is cached in sys.modules
+    code = f'import time; s = time.perf_counter(); {stmt}; print(time.perf_counter() - s)'
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return float(out.decode().strip().splitlines()[-1])
+
+
+def first_job_latency(**bag_kwargs) -> float:
+    from bag_mp.src.bag_mp.core import BagMP
+    from dask.distributed import get_client
+
+    s = time.perf_counter()
+    prj = BagMP(**bag_kwargs)
+    prj.submit(_noop, 1).result()
+    latency = time.perf_counter() - s
+    get_client().close()
+    return latency
+
+
+if __name__ == '__main__':
+    times = [import_time(IMPORT_STMT) for _ in range(NREPEAT)]
+    print(f'import bag_mp: {min(times) * 1e3:.4g} ms (best of {NREPEAT})')
+    times = [import_time(f'{IMPORT_STMT}.core') for _ in range(NREPEAT)]
+    print(f'import bag_mp.core: {min(times) * 1e3:.4g} ms (best of {NREPEAT})')
+    times = [import_time(f'{IMPORT_STMT}.core; bag_mp.src.bag_mp.core.BagMP')
+             for _ in range(NREPEAT)]
+    print(f'resolve bag_mp.core.BagMP: {min(times) * 1e3:.4g} ms (best of {NREPEAT})')
+
+    print(f'first job, new LocalCluster: {first_job_latency(processes=True):.4g} s')
+
+    sched_file = Path(tempfile.mkdtemp()) / 'scheduler.json'
+    print(f'first job, cluster autostart: '
+          f'{first_job_latency(scheduler_file=sched_file, autostart=True):.4g} s')
+    for i in range(NREPEAT):
+        print(f'first job, attach to scheduler file #{i}: '
+              f'{first_job_latency(scheduler_file=sched_file):.4g} s')
+
+    from dask.distributed import Client
+    Client(scheduler_file=str(sched_file)).shutdown()
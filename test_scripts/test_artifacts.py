@@ -0,0 +1,61 @@
+"""ArtifactStore tests on temporary directories.
+
+Run with pytest or as a script.
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from bag_mp.src.bag_mp.artifacts import ArtifactStore, GC_GRACE_PERIOD
+
+
+def test_restore_modified_file(tmp_path):
+    work_dir = tmp_path / 'work'
+    (work_dir / 'LIB').mkdir(parents=True)
+    (work_dir / 'LIB' / 'f.txt').write_text('abc')
+    store = ArtifactStore(tmp_path / 'store')
+    store.put('k', [work_dir / 'LIB'], work_dir)
+
+    dest = tmp_path / 'dest'
+    files = store.restore('k', dest)
+    assert files['LIB/f.txt'].read_text() == 'abc'
+    # same size, same inode and possibly the same mtime
+    with open(dest / 'LIB' / 'f.txt', 'r+') as f:
+        f.write('xyz')
+    store.restore('k', dest)
+    assert (dest / 'LIB' / 'f.txt').read_text() == 'abc'
+
+
+def test_gc_least_recently_used(tmp_path):
+    store = ArtifactStore(tmp_path / 'store')
+    for key in ('old', 'new'):
+        work_dir = tmp_path / key
+        work_dir.mkdir()
+        (work_dir / 'own.txt').write_text(key * 1000)
+        (work_dir / 'common.txt').write_text('common')
+        store.put(key, [work_dir], work_dir)
+
+    def blob_size(key, rel):
+        return store._blob_path(store.manifest(key)['files'][rel]['sha']).stat().st_size
+
+    old_blob = blob_size('old', 'own.txt')
+    budget = blob_size('new', 'own.txt') + blob_size('new', 'common.txt')
+    long_ago = time.time() - 2 * GC_GRACE_PERIOD
+    os.utime(store._manifest_path('old'), (long_ago, long_ago))
+    # the least recently used entry goes, but its blob is younger than the grace period
+    assert store.gc(budget) == 0
+    assert [entry['key'] for entry in store.entries()] == ['new']
+    assert store.restore('old', tmp_path / 'dest') is None
+
+    for blob in store.blobs_dir.glob('*/*.gz'):
+        os.utime(blob, (long_ago, long_ago))
+    assert store.gc(budget) == old_blob
+    files = store.restore('new', tmp_path / 'dest')
+    assert files['own.txt'].read_text() == 'new' * 1000
+
+
+if __name__ == '__main__':
+    test_restore_modified_file(Path(tempfile.mkdtemp()))
+    test_gc_least_recently_used(Path(tempfile.mkdtemp()))
+    print('passed')
@@ -0,0 +1,140 @@
+"""Micro-batching regression tests against a fake run_bag.sh, no BAG installation needed.
+
+Run with pytest or as a script.
+"""
+import gc
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from bag_mp.src.bag_mp.core import BagMP, job_key, get_config_dict
+from bag_mp.src.bag_mp.results import LazyResult
+
+RUN_BAG = f'#!/bin/bash\nexec {sys.executable} "$@"\n'
+
+SIM_CELL = '''
+import argparse
+import yaml
+
+parser = argparse.ArgumentParser()
+parser.add_argument('specs')
+parser.add_argument('--dump')
+parser.add_argument('--format')
+for flag in ('--no-cell', '--no-wrapper', '--no-tb', '--load', '--no-sim'):
+    parser.add_argument(flag, action='store_true')
+parser.add_argument('-x', action='store_true')
+args = parser.parse_args()
+with open(args.specs, 'r') as f:
+    specs = yaml.safe_load(f)
+with open(args.dump, 'w') as f:
+    yaml.dump({'gain': specs['x'] * 2, 'extract': args.x}, f)
+'''
+
+GEN_CELL = '''
+import argparse
+import yaml
+
+parser = argparse.ArgumentParser()
+parser.add_argument('specs')
+parser.add_argument('--dump')
+parser.add_argument('--format')
+for flag in ('--no-lay', '--no-sch', '-v', '-x'):
+    parser.add_argument(flag, action='store_true')
+args = parser.parse_args()
+with open(args.specs, 'r') as f:
+    specs = yaml.safe_load(f)
+with open(args.dump, 'w') as f:
+    yaml.dump({'w': specs['x'] * 3}, f)
+'''
+
+
+def fake_bag(**kwargs) -> BagMP:
+    """Returns a BagMP on an in-process cluster, running the fake scripts of a new BAG2
+    work directory. kwargs are passed to BagMP."""
+    work_dir = Path(tempfile.mkdtemp())
+    run_scripts = work_dir / 'BAG_framework' / 'run_scripts'
+    run_scripts.mkdir(parents=True)
+    (run_scripts / 'sim_cell.py').write_text(SIM_CELL)
+    (run_scripts / 'gen_cell.py').write_text(GEN_CELL)
+    (work_dir / 'run_bag.sh').write_text(RUN_BAG)
+    (work_dir / 'run_bag.sh').chmod(0o755)
+    (work_dir / 'tmp').mkdir()
+    os.environ['BAG2_FRAMEWORK'] = str(work_dir / 'BAG_framework')
+    os.environ['BAG_TEMP_DIR'] = str(work_dir / 'tmp')
+    get_config_dict.cache_clear()
+    return BagMP(processes=False, n_workers=1, **kwargs)
+
+
+def sim_flags(**flags):
+    # what sim_cell hands to the batcher
+    kwargs = dict(dep=None, gen_cell=False, gen_wrapper=False, gen_tb=False,
+                  load_results=False, run_sim=True, log_file=None, extract=True,
+                  bag_id='BAG2', io_format='yaml')
+    kwargs.update(flags)
+    return kwargs
+
+
+def test_batch_same_specs_different_flags():
+    prj = fake_bag()
+    specs = {'x': 10}
+    jobs = []
+    for extract in (False, True):
+        flags = sim_flags(extract=extract)
+        jobs.append((job_key('sim_cell', specs, flags), specs, flags))
+    results = prj._run_batch('sim_cell', 'BAG2', 'yaml', jobs)
+    assert [ok for ok, _ in results] == [True, True], results
+    assert [output[0] for _, output in results] == [
+        {'gain': 20, 'extract': False},
+        {'gain': 20, 'extract': True},
+    ]
+    assert results[0][1][1] != results[1][1][1], 'jobs share a log file'
+
+
+def test_batch_gen_cell():
+    prj = fake_bag()
+    jobs = []
+    for x in (1, 2):
+        specs = {'x': x}
+        flags = dict(dep=None, gen_lay=False, gen_sch=True, run_lvs=False, run_rcx=False,
+                     log_file=None, bag_id='BAG2', io_format='yaml')
+        jobs.append((job_key('gen_cell', specs, flags), specs, flags))
+    results = prj._run_batch('gen_cell', 'BAG2', 'yaml', jobs)
+    assert [ok for ok, _ in results] == [True, True], results
+    assert [output[0] for _, output in results] == [{'w': 3}, {'w': 6}]
+
+
+def test_unbatched_same_specs_different_flags():
+    prj = fake_bag()
+    specs = {'x': 10}
+    futs = [prj.sim_cell(specs, run_sim=True, extract=extract) for extract in (False, True)]
+    outputs = [fut.result() for fut in futs]
+    assert [output[0]['extract'] for output in outputs] == [False, True]
+    assert outputs[0][1] != outputs[1][1], 'jobs share a log file'
+
+
+def test_spilled_result_released(tmp_path):
+    prj = fake_bag(journal=tmp_path, spill_threshold=0)
+    fut = prj.sim_cell({'x': 10}, run_sim=True)
+    result, _ = fut.result()
+    assert isinstance(result, LazyResult)
+    assert result.path.parent == Path(os.environ['BAG_TEMP_DIR']).resolve() / 'spill'
+    assert result.result(['gain']) == {'gain': 20}
+    key = fut.key
+    del fut
+    gc.collect()
+    assert not result.path.exists()
+    with pytest.raises(FileNotFoundError):
+        result.to_future()
+    # the spilled result is gone, resuming the journal has to run the job again
+    assert prj.journal.status(key) != 'done'
+
+
+if __name__ == '__main__':
+    test_batch_same_specs_different_flags()
+    test_batch_gen_cell()
+    test_unbatched_same_specs_different_flags()
+    test_spilled_result_released(Path(tempfile.mkdtemp()))
+    print('passed')
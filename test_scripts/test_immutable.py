@@ -0,0 +1,26 @@
+"""Tests of the canonical digest used for job keys, journal entries and artifacts.
+
+Run with pytest or as a script.
+"""
+from bag_mp.src.bag_mp.immutable import digest, to_immutable
+
+
+def test_digest_canonical():
+    assert digest({'b': 1, 'a': [1, 2]}) == digest({'a': [1, 2], 'b': 1})
+    assert digest({'x', 'y'}) == digest({'y', 'x'})
+    assert digest(to_immutable({'a': [1]})) == digest({'a': [1]})
+
+
+def test_digest_unambiguous():
+    assert digest({'a': {'x': 2}}) != digest({'a': [('x', 2)]})
+    assert digest([1, 2]) != digest((1, 2))
+    assert digest(1) != digest(1.0)
+    assert digest(1) != digest(True)
+    assert digest('1') != digest(1)
+    assert digest(None) != digest('None')
+
+
+if __name__ == '__main__':
+    test_digest_canonical()
+    test_digest_unambiguous()
+    print('passed')
@@ -0,0 +1,34 @@
+"""BatchJournal replay tests.
+
+Run with pytest or as a script.
+"""
+import tempfile
+from pathlib import Path
+
+from bag_mp.src.bag_mp.journal import BatchJournal, run_journaled, load_result
+
+
+def test_replay(tmp_path):
+    journal = BatchJournal(tmp_path)
+    for key in ('a', 'b', 'c'):
+        journal.record(key, 'submitted', stage='sim_cell')
+    journal.record('a', 'failed', error='boom')
+    journal.record('b', 'done')
+    run_journaled(journal.result_path('c'), dict, x=1)
+    # a client killed while appending a line
+    with open(tmp_path / 'journal.jsonl', 'a') as f:
+        f.write('{"key": "d", "sta')
+
+    journal = BatchJournal(tmp_path)
+    assert journal.entries()['a']['error'] == 'boom'
+    assert journal.entries()['a']['stage'] == 'sim_cell'
+    assert [journal.status(key) for key in ('a', 'b', 'c', 'd')] == [
+        'failed', 'done', 'done', None]
+    # the result file is authoritative, c was never recorded as done
+    assert load_result(journal.result_path('c')) == {'x': 1}
+    assert journal.summary() == {'failed': 1, 'done': 2}
+
+
+if __name__ == '__main__':
+    test_replay(Path(tempfile.mkdtemp()))
+    print('passed')
@@ -0,0 +1,79 @@
+"""FlowManager.staged_evaluate and top-k gate tests, the flow runs on an in-process cluster.
+
+Run with pytest or as a script.
+"""
+import random
+import tempfile
+from pathlib import Path
+
+from bag_mp.src.bag_mp.manager import FlowManager, _TopKGate
+
+from test_batch import fake_bag
+
+
+def top_k(scores, k):
+    # ties go to the earlier design, like the gate
+    ranked = sorted((idx for idx, score in enumerate(scores) if score is not None),
+                    key=lambda idx: (-scores[idx], idx))
+    return set(ranked[:k])
+
+
+def test_topk_gate_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(200):
+        n = rng.randint(1, 12)
+        k = rng.randint(1, n)
+        scores = [rng.choice([None, 0, 1, 2, 3, rng.random()]) for _ in range(n)]
+        gate = _TopKGate(k, n)
+        admitted, rejected = set(), set()
+        for idx in rng.sample(range(n), n):
+            newly_admitted, newly_rejected = gate.update(idx, scores[idx])
+            assert not (admitted | rejected) & set(newly_admitted + newly_rejected)
+            admitted.update(newly_admitted)
+            rejected.update(newly_rejected)
+        assert admitted == top_k(scores, k), (scores, k)
+        assert admitted | rejected == set(range(n))
+
+
+def _screen(x):
+    if x < 0:
+        raise SystemError('screening failed')
+    return {'score': x}, None
+
+
+def _evaluate(x):
+    return x * 10, None
+
+
+class Flow(FlowManager):
+    def batch_evaluate(self, batch_of_designs, sync=False):
+        raise NotImplementedError
+
+    def screen_design(self, design):
+        return self.prj.submit(_screen, design['x'])
+
+    def evaluate_design(self, design, screen_result):
+        return self.prj.submit(_evaluate, design['x'])
+
+
+def test_staged_evaluate():
+    fake_bag()
+    template = Path(tempfile.mkdtemp()) / 'specs.yaml'
+    template.write_text('x: {{ x }}\n')
+    flow = Flow(template, n_workers=1)
+    designs = [{'x': x} for x in (3, -1, 5, 1, 4)]
+
+    screen, final = flow.staged_evaluate(designs, keep=lambda d, res: res['score'] != 5,
+                                         sync=True)
+    assert screen[1] is SystemError
+    assert final == [(30, None), None, None, (10, None), (40, None)]
+
+    _, final = flow.staged_evaluate(designs, top_k=2, score=lambda d, res: res['score'],
+                                    sync=True)
+    assert final == [None, None, (50, None), None, (40, None)]
+
+
+if __name__ == '__main__':
+    test_topk_gate_matches_brute_force()
+    test_staged_evaluate()
+    print('passed')
@@ -0,0 +1,42 @@
+"""Metric rendering tests, no cluster needed.
+
+Run with pytest or as a script.
+"""
+from bag_mp.src.bag_mp.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_render():
+    registry = Registry()
+    jobs = registry.register(Counter('jobs_total', 'Jobs.', ('stage',)))
+    running = registry.register(Gauge('running', 'Running "jobs".'))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', ('stage',),
+                                          buckets=(1, 10)))
+    registry.add_collector(lambda: running.set(2))
+    jobs.inc(stage='sim_cell')
+    jobs.inc(2, stage='gen_"cell"')
+    for value in (0.5, 5, 50):
+        latency.observe(value, stage='sim_cell')
+
+    assert registry.render().splitlines() == [
+        '# HELP jobs_total Jobs.',
+        '# TYPE jobs_total counter',
+        'jobs_total{stage="gen_\\"cell\\""} 2.0',
+        'jobs_total{stage="sim_cell"} 1.0',
+        '# HELP running Running "jobs".',
+        '# TYPE running gauge',
+        'running 2.0',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{stage="sim_cell",le="1.0"} 1',
+        'latency_seconds_bucket{stage="sim_cell",le="10.0"} 2',
+        'latency_seconds_bucket{stage="sim_cell",le="+Inf"} 3',
+        'latency_seconds_sum{stage="sim_cell"} 55.5',
+        'latency_seconds_count{stage="sim_cell"} 3',
+    ]
+    assert latency.quantile(0.5, stage='sim_cell') == 5.5
+    assert latency.quantile(0.5, stage='gen_cell') is None
+
+
+if __name__ == '__main__':
+    test_render()
+    print('passed')
@@ -0,0 +1,31 @@
+"""Priority and admission control tests.
+
+Run with pytest or as a script.
+"""
+from operator import add
+
+from bag_mp.src.bag_mp.core import BagMP
+from bag_mp.src.bag_mp.scheduling import AdmissionController
+
+from test_batch import fake_bag
+
+
+def test_last_priority_does_not_count():
+    admission = AdmissionController()
+    assert admission.last_priority('a', 'batch') == admission.priority('a', 'batch')
+    assert admission.last_priority('a', 'batch') == admission.last_priority('a', 'batch')
+    # another owner's n-th job shares the priority of a's n-th job
+    assert admission.priority('b', 'batch') == admission.last_priority('a', 'batch')
+    assert admission.priority('a', 'batch') < admission.last_priority('b', 'batch')
+
+
+def test_submit_on_class_and_instance():
+    prj = fake_bag()
+    assert prj.submit(add, 1, 2, priority='interactive').result() == 3
+    assert BagMP.submit(add, 1, 2).result() == 3
+
+
+if __name__ == '__main__':
+    test_last_priority_does_not_count()
+    test_submit_on_class_and_instance()
+    print('passed')
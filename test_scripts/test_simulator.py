@@ -0,0 +1,59 @@
+"""Trace replay and simulator tests on hand-written traces, no cluster needed.
+
+Run with pytest or as a script.
+"""
+from bag_mp.src.bag_mp.simulator import jobs_from_trace, simulate, Policy, SimJob
+
+
+def record(key, submit, start, end, session='a', **info):
+    return dict(key=key, stage='sim_cell', submit=submit, start=start, end=end,
+                session=session, **info)
+
+
+def test_jobs_from_trace_sessions():
+    # two runs appended to one trace, a day apart
+    records = [record('j1', 100, 100, 110), record('j2', 105, 110, 120),
+               record('j3', 86500, 86500, 86505, session='b')]
+    jobs = {job.key: job for job in jobs_from_trace(records)}
+    assert [jobs[key].submit for key in ('j1', 'j2', 'j3')] == [0, 5, 20]
+
+
+def test_jobs_from_trace_batch():
+    records = [record('j1', 0, 0, 12, batched=True), record('j2', 0, 0, 12, batched=True),
+               record('b', 1, 2, 12, members=['j1', 'j2'], priority='batch'),
+               record('j3', 0, 12, 15, deps=['j1'])]
+    jobs = {job.key: job for job in jobs_from_trace(records)}
+    assert sorted(jobs) == ['b', 'j3']
+    assert jobs['b'].duration == 10
+    assert jobs['j3'].deps == ['b']
+
+
+def test_simulate_workers_and_licenses():
+    jobs = [SimJob(f'j{i}', 'sim_cell', 10, resources={'spectre': 1}) for i in range(4)]
+    assert simulate(jobs, 2).makespan == 20
+    assert simulate(jobs, 4).makespan == 10
+    result = simulate(jobs, 4, licenses={'spectre': 1})
+    assert result.makespan == 40
+    assert result.license_utilization == {'spectre': 1.0}
+    assert result.max_wait == 30
+
+
+def test_simulate_deps_and_batches():
+    jobs = [SimJob('gen', 'gen_cell', 5), SimJob('sim', 'sim_cell', 10, deps=['gen'])]
+    result = simulate(jobs, 2)
+    assert result.makespan == 15
+    assert result.schedule['sim'][1] == 5
+
+    # three 10 s jobs, 4 s of which start BAG, in one process
+    jobs = [SimJob(f'j{i}', 'sim_cell', 10) for i in range(3)]
+    result = simulate(jobs, 1, policy=Policy(batch_size=3, startup_time=4))
+    assert result.n_processes == 1
+    assert result.makespan == 4 + 3 * 6
+
+
+if __name__ == '__main__':
+    test_jobs_from_trace_sessions()
+    test_jobs_from_trace_batch()
+    test_simulate_workers_and_licenses()
+    test_simulate_deps_and_batches()
+    print('passed')